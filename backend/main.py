@@ -3,39 +3,127 @@ from __future__ import annotations
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from fastapi.responses import JSONResponse, FileResponse, ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator, Union, Callable
 from datetime import datetime
-import pdfplumber
 import io
 import os
-import json
+import orjson
+import re
+import math
+import asyncio
+import anyio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import httpx
+import aiofiles
+import pickle
+from cachetools import LRUCache, TTLCache
+import zstandard as zstd
+import hashlib
+import functools
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern
+from pymongo.errors import OperationFailure
 from bson import ObjectId
-import shutil
 from pathlib import Path
 from urllib.parse import quote_plus
-import PyPDF2
-import fitz  
+import fitz
+import pypdfium2 as pdfium
+import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+
+# ============================================================================
+# LOGGING
+# ============================================================================
+# Records are queued and written by a listener thread, so request handlers never block on stdout
+log_queue: queue.Queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+
+if not logging.getLogger().handlers:
+    logging.getLogger().addHandler(QueueHandler(log_queue))
+    logging.getLogger().setLevel(logging.INFO)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+logger = logging.getLogger("beyondchats")
 
 # Load environment variables from .env file if it exists
 try:
     from dotenv import load_dotenv
     load_dotenv()
 except ImportError:
-    print("⚠️  python-dotenv not installed. Install with: pip install python-dotenv")
+    logger.warning("⚠️  python-dotenv not installed. Install with: pip install python-dotenv")
+
+# Optional: semantic citation search with a local embedding model
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Optional: HNSW index for approximate search; exact NumPy scoring is used without it
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
 
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "beyondchats_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 200))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 10))
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 MODEL_NAME = "meta-llama/llama-3.2-3b-instruct:free"  # Using free model
+LLM_TEMPERATURE = 0.7
+LLM_MAX_TOKENS = 1000  # Default completion cap; callers with a known output size pass a tighter one
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 15))
+# Slowest generation speed still treated as healthy; long completions get a proportionally longer timeout
+LLM_MIN_TOKENS_PER_SECOND = 20
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 10))
+# Structured output is only honoured by some OpenRouter providers, and slows down others
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "false").lower() == "true"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+LLM_MEMORY_CACHE_SIZE = int(os.getenv("LLM_MEMORY_CACHE_SIZE", 1024))
+LLM_MEMORY_CACHE_TTL_SECONDS = 3600
+QUERY_CACHE_SIZE = 4096
+PDF_QUERY_CACHE_SIZE = 256  # Vectorized questions memoized per loaded citation index
+LLM_SEMANTIC_CACHE_MIN_SCORE = 0.92
+LLM_SEMANTIC_CACHE_CANDIDATES = 200
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_SEARCH_ENABLED = SentenceTransformer is not None
+LLM_SEMANTIC_CACHE_ENABLED = SEMANTIC_SEARCH_ENABLED
+# Speculatively answers likely follow-up questions after each chat turn; costs extra LLM calls
+CHAT_PREFETCH_FOLLOWUPS = (
+    os.getenv("CHAT_PREFETCH_FOLLOWUPS", "false").lower() == "true"
+    and LLM_SEMANTIC_CACHE_ENABLED
+    and bool(OPENROUTER_API_KEY) and OPENROUTER_API_KEY != "your_key_here"
+)
+CHAT_PREFETCH_COUNT = 3
 UPLOAD_DIR = "./uploads"
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # Larger chunks mean fewer read/write round-trips
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+IMAGE_PROBE_PAGES = 3
+PAGE_INSERT_BATCH = 100
+LEADING_TEXT_CHARS = 4000  # Prompt context for quizzes and recommendations, stored on the pdfs doc
+CPU_COUNT = os.cpu_count() or 1
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", CPU_COUNT))
+# Every web worker owns its own extraction pool, so split the cores between them when the
+# worker count is known; a bare `uvicorn main:app` is a single worker and gets them all
+EXTRACT_WORKERS = int(os.getenv(
+    "EXTRACT_WORKERS",
+    max(1, CPU_COUNT // WEB_CONCURRENCY) if "WEB_CONCURRENCY" in os.environ else CPU_COUNT
+))
 
 # Create upload directory
 Path(UPLOAD_DIR).mkdir(exist_ok=True)
@@ -45,6 +133,8 @@ Path(UPLOAD_DIR).mkdir(exist_ok=True)
 # ============================================================================
 class Database:
     client: Any = None
+    # Resolved once at connect time so request handlers don't re-index the client
+    database: Any = None
     
 db = Database()
 
@@ -53,28 +143,159 @@ async def connect_db():
     try:
         mongodb_uri = MONGODB_URI
         
-        db.client = AsyncIOMotorClient(mongodb_uri)
+        # Keep warm connections around so the first requests don't pay for TLS handshakes
+        db.client = AsyncIOMotorClient(
+            mongodb_uri,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=300000,
+            serverSelectionTimeoutMS=5000,
+            compressors="zstd"
+        )
         
         # Test the connection
         await db.client.admin.command('ping')
-        print("✅ Connected to MongoDB")
+        db.database = db.client[DATABASE_NAME]
+        logger.info("✅ Connected to MongoDB")
     except Exception as e:
-        print(f"❌ MongoDB Connection Error: {str(e)}")
-        print("\n💡 Troubleshooting:")
-        print("   1. Check Network Access whitelist in MongoDB Atlas")
-        print("   2. Verify database user credentials")
-        print("   3. Ensure connection string format is correct")
+        logger.error(
+            f"❌ MongoDB Connection Error: {str(e)}\n"
+            "💡 Troubleshooting:\n"
+            "   1. Check Network Access whitelist in MongoDB Atlas\n"
+            "   2. Verify database user credentials\n"
+            "   3. Ensure connection string format is correct"
+        )
         raise
+    
+    await ensure_indexes()
+
+async def ensure_indexes():
+    """Create indexes for the hot query paths (no-op if they already exist)"""
+    database = db.database
+    await database["pdfs"].create_index([("uploaded_at", -1)])
+    await database["pdf_pages"].create_index([("pdf_id", 1), ("page_num", 1)], unique=True)
+    await database["attempts"].create_index("quiz_id")
+    await database["attempts"].create_index([("submitted_at", -1)])
+    await database["chats"].create_index([("updated_at", -1)])
+    await database["quizzes"].create_index("pdf_id")
+    await ensure_ttl_index(database, "llm_cache", LLM_CACHE_TTL_SECONDS)
+    await ensure_ttl_index(database, "llm_semantic_cache", LLM_CACHE_TTL_SECONDS)
+    await database["llm_semantic_cache"].create_index([("scope", 1), ("created_at", -1)])
+    logger.info("✅ MongoDB indexes ready")
+
+INDEX_OPTIONS_CONFLICT = 85
+
+async def ensure_ttl_index(database, collection: str, ttl_seconds: int):
+    """Create the created_at TTL index, updating its expiry in place if LLM_CACHE_TTL_SECONDS changed"""
+    try:
+        await database[collection].create_index("created_at", expireAfterSeconds=ttl_seconds)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        await database.command({
+            "collMod": collection,
+            "index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": ttl_seconds}
+        })
+        logger.info(f"🔄 Updated {collection} TTL to {ttl_seconds}s")
 
 async def close_db():
     if db.client:
         db.client.close()
-        print("❌ Closed MongoDB connection")
+        logger.info("🔌 Closed MongoDB connection")
 
 def get_database():
-    if db.client is None:
+    if db.database is None:
         raise HTTPException(status_code=500, detail="Database not connected")
-    return db.client[DATABASE_NAME]
+    return db.database
+
+# Quizzes, attempts and LLM cache entries can be regenerated, so their writes
+# are acknowledged by the primary without waiting on the journal
+UNJOURNALED_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+def get_unjournaled_collection(name: str):
+    return get_database()[name].with_options(write_concern=UNJOURNALED_WRITE_CONCERN)
+
+OBJECT_ID_RE = re.compile(r"[0-9a-fA-F]{24}")
+
+@functools.lru_cache(maxsize=1024)
+def parse_oid(value: str) -> ObjectId:
+    """Parse a hex id into an ObjectId, reusing the result for hot ids"""
+    if not isinstance(value, str) or not OBJECT_ID_RE.fullmatch(value):
+        raise HTTPException(status_code=400, detail=f"Invalid id: {value}")
+    return ObjectId(value)
+
+# Page text is stored zstd-compressed (~4x smaller on disk, in cache and on the wire).
+# zstd contexts aren't thread-safe; these are only used on the event loop thread.
+zstd_compressor = zstd.ZstdCompressor(level=3)
+zstd_decompressor = zstd.ZstdDecompressor()
+
+def compress_text(text: str) -> bytes:
+    return zstd_compressor.compress(text.encode("utf-8"))
+
+def decompress_text(data: bytes) -> str:
+    return zstd_decompressor.decompress(data).decode("utf-8")
+
+async def get_pages_text(pdf_id: ObjectId) -> Dict[str, str]:
+    """Load a PDF's page texts from the pdf_pages collection, in page order"""
+    cursor = get_database()["pdf_pages"].find(
+        {"pdf_id": pdf_id},
+        projection={"_id": 0, "page_num": 1, "text_zstd": 1}
+    ).sort("page_num", 1)
+    return {str(page["page_num"]): decompress_text(page["text_zstd"]) async for page in cursor}
+
+async def get_leading_text(pdf_id: ObjectId, max_chars: int) -> str:
+    """Join a PDF's pages in order, stopping once max_chars have been collected"""
+    cursor = get_database()["pdf_pages"].find(
+        {"pdf_id": pdf_id},
+        projection={"_id": 0, "text_zstd": 1}
+    ).sort("page_num", 1).batch_size(8)
+    
+    parts = []
+    size = 0
+    async for page in cursor:
+        text = decompress_text(page["text_zstd"])
+        parts.append(text)
+        size += len(text) + 1
+        if size >= max_chars:
+            break
+    await cursor.close()
+    
+    return " ".join(parts)[:max_chars]
+
+async def get_context_text(pdf_id: ObjectId, max_chars: int) -> str:
+    """Leading text of a PDF, served from the copy stored at upload when it's long enough"""
+    if max_chars <= LEADING_TEXT_CHARS:
+        pdf = await get_database()["pdfs"].find_one({"_id": pdf_id}, projection={"leading_text": 1})
+        if pdf and "leading_text" in pdf:
+            return pdf["leading_text"][:max_chars]
+    return await get_leading_text(pdf_id, max_chars)
+
+# ============================================================================
+# LLM HTTP CLIENT
+# ============================================================================
+# Created at startup and shared across requests so connections and TLS sessions are reused
+llm_client: Optional[httpx.AsyncClient] = None
+# Caps concurrent upstream calls when quiz parts and chats fan out
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+# Identical prompts already on the wire, so concurrent duplicates share one completion
+llm_inflight: Dict[Tuple[str, bool], asyncio.Future] = {}
+# Idle upstream connections are kept this long, so calls a few seconds apart skip the TLS handshake
+LLM_KEEPALIVE_EXPIRY = 60.0
+llm_warmup_task: Optional[asyncio.Task] = None
+
+async def warm_llm_connection():
+    """Open the upstream connection at startup so the first LLM call doesn't pay for it"""
+    try:
+        # Only the handshake matters; whatever status comes back is ignored
+        await llm_client.head("/models")
+    except httpx.HTTPError as e:
+        logger.warning(f"⚠️  Could not pre-connect to OpenRouter: {e}")
+
+# ============================================================================
+# PDF EXTRACTION POOL
+# ============================================================================
+# Created at startup; None falls back to the loop's default thread pool
+extract_pool: Optional[ProcessPoolExecutor] = None
 
 # ============================================================================
 # PYDANTIC SCHEMAS
@@ -86,11 +307,53 @@ class QuizQuestion(BaseModel):
     explanation: str
     question_type: str
 
+QUIZ_QUESTIONS_ADAPTER = TypeAdapter(List[QuizQuestion])
+
+class QuizQuestionList(BaseModel):
+    questions: List[QuizQuestion]
+
+# A JSON-mode object or a bare array, decoded and validated straight from the raw reply
+QUIZ_REPLY_ADAPTER = TypeAdapter(Union[QuizQuestionList, List[QuizQuestion]])
+
+class YouTubeRecommendation(BaseModel):
+    title: str
+    channel: str
+    reason: str
+
+class YouTubeRecommendationList(BaseModel):
+    recommendations: List[YouTubeRecommendation]
+
+class YouTubeRecommendationBatch(BaseModel):
+    results: List[List[YouTubeRecommendation]]
+
+def get_response_format(schema: type) -> Dict[str, Any]:
+    """OpenAI-style json_schema response_format for a pydantic model"""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "schema": schema.model_json_schema()}
+    }
+
+QUIZ_RESPONSE_FORMAT = get_response_format(QuizQuestionList)
+YOUTUBE_RESPONSE_FORMAT = get_response_format(YouTubeRecommendationList)
+YOUTUBE_BATCH_RESPONSE_FORMAT = get_response_format(YouTubeRecommendationBatch)
+
+def check_object_id(value: str) -> str:
+    """Reject malformed ids at validation time (422) instead of inside the handler"""
+    if not OBJECT_ID_RE.fullmatch(value):
+        raise ValueError("must be a 24-character hex id")
+    return value
+
+def check_optional_object_id(value: Optional[str]) -> Optional[str]:
+    """Like check_object_id, treating a missing or empty id as None"""
+    return check_object_id(value) if value else None
+
 class QuizGenerateRequest(BaseModel):
     pdf_id: Optional[str] = None
     num_mcq: int = 5
     num_saq: int = 3
     num_laq: int = 2
+    
+    _check_ids = field_validator("pdf_id")(check_optional_object_id)
 
 class QuizAnswer(BaseModel):
     question_index: int
@@ -99,128 +362,316 @@ class QuizAnswer(BaseModel):
 class QuizSubmitRequest(BaseModel):
     quiz_id: str
     answers: List[QuizAnswer]
+    
+    _check_ids = field_validator("quiz_id")(check_object_id)
 
 class ChatRequest(BaseModel):
     chat_id: Optional[str] = None
     message: str
     pdf_id: Optional[str] = None
+    max_tokens: Optional[int] = Field(None, ge=50, le=4000)  # Reply length cap; CHAT_MAX_TOKENS when unset
+    
+    _check_ids = field_validator("chat_id", "pdf_id")(check_optional_object_id)
 
 class YouTubeRequest(BaseModel):
     topic: str
     pdf_id: Optional[str] = None
+    
+    _check_ids = field_validator("pdf_id")(check_optional_object_id)
 
 # ============================================================================
 # UTILITY FUNCTIONS 
 # ============================================================================
-def extract_text_with_pdfplumber(pdf_path: str) -> Dict[str, str]:
-    """Method 1: Extract using pdfplumber"""
+def probe_pdf(pdf_path: str) -> Tuple[int, bool]:
+    """Return the page count and whether sampled pages are images with no text"""
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+        # Sample across the document so an image-only cover doesn't decide it
+        step = max((total_pages - 1) // (IMAGE_PROBE_PAGES - 1), 1)
+        sample = range(0, total_pages, step)[:IMAGE_PROBE_PAGES]
+        is_image_based = bool(sample) and all(
+            not doc[i].get_text("text").strip() and doc[i].get_images()
+            for i in sample
+        )
+        return total_pages, is_image_based
+
+def extract_text_with_pymupdf(pdf_path: str, start: int = 0, end: Optional[int] = None) -> Dict[str, str]:
+    """Method 1: Extract pages [start:end] using PyMuPDF (fitz)"""
     pages_text = {}
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                text = page.extract_text() or ""
+        # Each worker process opens its own document; fitz handles can't be shared
+        with fitz.open(pdf_path) as doc:
+            for i, page in enumerate(doc.pages(start, end if end is not None else len(doc)), start=start):
+                # "text" mode skips the block/table layout analysis
+                text = page.get_text("text") or ""
                 if text.strip():
                     pages_text[str(i + 1)] = text
         return pages_text
     except Exception as e:
-        print(f"⚠️  pdfplumber failed: {str(e)}")
+        logger.warning(f"⚠️  PyMuPDF failed: {str(e)}")
         return {}
 
-def extract_text_with_pypdf2(pdf_path: str) -> Dict[str, str]:
-    """Method 2: Extract using PyPDF2"""
+def extract_text_with_pypdfium2(pdf_path: str, start: int = 0, end: Optional[int] = None) -> Dict[str, str]:
+    """Method 2: Extract pages [start:end] using pypdfium2"""
     pages_text = {}
     try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for i, page in enumerate(pdf_reader.pages):
-                text = page.extract_text() or ""
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for i in range(start, end if end is not None else len(pdf)):
+                textpage = pdf[i].get_textpage()
+                text = textpage.get_text_bounded() or ""
+                textpage.close()
                 if text.strip():
                     pages_text[str(i + 1)] = text
+        finally:
+            pdf.close()
         return pages_text
     except Exception as e:
-        print(f"⚠️  PyPDF2 failed: {str(e)}")
+        logger.warning(f"⚠️  pypdfium2 failed: {str(e)}")
         return {}
 
-def extract_text_with_pymupdf(pdf_path: str) -> Dict[str, str]:
-    """Method 3: Extract using PyMuPDF (fitz)"""
+async def extract_page_ranges(extract, pdf_path: str, total_pages: int) -> Dict[str, str]:
+    """Run an extractor over one contiguous page range per pool worker"""
+    loop = asyncio.get_running_loop()
+    step = math.ceil(total_pages / min(EXTRACT_WORKERS, total_pages))
+    parts = await asyncio.gather(*(
+        loop.run_in_executor(extract_pool, extract, pdf_path, start, min(start + step, total_pages))
+        for start in range(0, total_pages, step)
+    ))
+    
     pages_text = {}
+    for part in parts:
+        pages_text.update(part)
+    return pages_text
+
+async def extract_text_from_pdf(pdf_path: str) -> Dict[str, str]:
+    """Extract text from PDF with PyMuPDF across the process pool, falling back to pypdfium2"""
+    logger.info(f"📄 Attempting to extract text from: {pdf_path}")
+    loop = asyncio.get_running_loop()
+    
     try:
-        doc = fitz.open(pdf_path)
-        for i in range(len(doc)):
-            page = doc[i]
-            text = page.get_text() or ""
-            if text.strip():
-                pages_text[str(i + 1)] = text
-        doc.close()
-        return pages_text
+        # Opening parses the xref table, which is slow on large files
+        total_pages, is_image_based = await asyncio.to_thread(probe_pdf, pdf_path)
     except Exception as e:
-        print(f"⚠️  PyMuPDF failed: {str(e)}")
-        return {}
-
-def extract_text_from_pdf(pdf_path: str) -> Dict[str, str]:
-    """Extract text from PDF using multiple methods as fallback"""
-    print(f"📄 Attempting to extract text from: {pdf_path}")
+        logger.warning(f"⚠️  PyMuPDF failed: {str(e)}")
+        total_pages, is_image_based = 0, False
     
-    pages_text = extract_text_with_pdfplumber(pdf_path)
-    if pages_text:
-        print(f"✅ Extracted {len(pages_text)} pages using pdfplumber")
-        return pages_text
+    if is_image_based:
+        logger.warning(f"⚠️  PDF has {total_pages} pages of scanned images, skipping text extraction")
+        return {str(i + 1): "[Image-based page - OCR needed]" for i in range(total_pages)}
+    
+    pages_text = {}
+    if total_pages > 0:
+        pages_text = await extract_page_ranges(extract_text_with_pymupdf, pdf_path, total_pages)
     
-    print("📄 Trying PyMuPDF...")
-    pages_text = extract_text_with_pymupdf(pdf_path)
     if pages_text:
-        print(f"✅ Extracted {len(pages_text)} pages using PyMuPDF")
+        logger.info(f"✅ Extracted {len(pages_text)} pages using PyMuPDF")
         return pages_text
     
-    print("📄 Trying PyPDF2...")
-    pages_text = extract_text_with_pypdf2(pdf_path)
+    logger.info("📄 Trying pypdfium2...")
+    if total_pages > 0:
+        pages_text = await extract_page_ranges(extract_text_with_pypdfium2, pdf_path, total_pages)
+    else:
+        # PyMuPDF couldn't even open it, so the page count is unknown
+        pages_text = await loop.run_in_executor(extract_pool, extract_text_with_pypdfium2, pdf_path)
     if pages_text:
-        print(f"✅ Extracted {len(pages_text)} pages using PyPDF2")
+        logger.info(f"✅ Extracted {len(pages_text)} pages using pypdfium2")
         return pages_text
     
-    try:
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
-        doc.close()
-        
-        if total_pages > 0:
-            print(f"⚠️  PDF has {total_pages} pages but no extractable text")
-            return {str(i + 1): "[Image-based page - OCR needed]" for i in range(total_pages)}
-    except:
-        pass
+    if total_pages > 0:
+        logger.warning(f"⚠️  PDF has {total_pages} pages but no extractable text")
+        return {str(i + 1): "[Image-based page - OCR needed]" for i in range(total_pages)}
     
     raise HTTPException(
         status_code=422, 
         detail="Unable to extract text from PDF. The file might be corrupted, password-protected, or image-based."
     )
 
+WORD_RE = re.compile(r"\S+")
+
 def chunk_text(text: str, chunk_size: int = 1000) -> List[str]:
-    """Split text into chunks"""
-    words = text.split()
+    """Split text into chunks on word boundaries, slicing the source by offset"""
     chunks = []
-    current_chunk = []
+    chunk_start = None
+    chunk_end = 0
     current_size = 0
     
-    for word in words:
-        current_size += len(word) + 1
-        if current_size > chunk_size:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [word]
-            current_size = len(word)
+    for match in WORD_RE.finditer(text):
+        word_size = match.end() - match.start()
+        if chunk_start is None:
+            chunk_start = match.start()
+            current_size = word_size
+        elif current_size + word_size + 1 > chunk_size:
+            chunks.append(text[chunk_start:chunk_end])
+            chunk_start = match.start()
+            current_size = word_size
         else:
-            current_chunk.append(word)
+            current_size += word_size + 1
+        chunk_end = match.end()
     
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
+    if chunk_start is not None:
+        chunks.append(text[chunk_start:chunk_end])
     
     return chunks
 
-async def call_llm(prompt: str, system_prompt: str = "You are a helpful AI assistant.", use_fallback: bool = True) -> str:
-    """Call OpenRouter API with improved error handling and fallback"""
+# Hot responses are served from process memory; Mongo's llm_cache is shared across workers
+llm_memory_cache: TTLCache = TTLCache(maxsize=LLM_MEMORY_CACHE_SIZE, ttl=LLM_MEMORY_CACHE_TTL_SECONDS)
+
+def get_llm_cache_key(
+    prompt: str,
+    system_prompt: str,
+    response_format: Optional[Dict[str, Any]] = None,
+    max_tokens: int = LLM_MAX_TOKENS
+) -> str:
+    """Hash everything that shapes a completion into an llm_cache key"""
+    parts = [MODEL_NAME, system_prompt, prompt, str(LLM_TEMPERATURE), str(max_tokens)]
+    if response_format:
+        parts.append(response_format["json_schema"]["name"])
+    raw = "\x00".join(parts)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+async def get_cached_llm_response(cache_key: str) -> Optional[str]:
+    """Look up a previous LLM response in memory, then Mongo; cache errors never fail the request"""
+    cached = llm_memory_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        cached = await get_database()["llm_cache"].find_one({"_id": cache_key}, projection={"response": 1})
+    except Exception as e:
+        logger.warning(f"⚠️  LLM cache lookup failed: {str(e)}")
+        return None
+    
+    if not cached:
+        return None
+    llm_memory_cache[cache_key] = cached["response"]
+    return cached["response"]
+
+async def cache_llm_response(cache_key: str, response: str) -> None:
+    """Store an LLM response; upsert so concurrent identical calls don't collide"""
+    llm_memory_cache[cache_key] = response
+    try:
+        await get_unjournaled_collection("llm_cache").update_one(
+            {"_id": cache_key},
+            {"$set": {"response": response, "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"⚠️  LLM cache write failed: {str(e)}")
+
+def get_semantic_cache_scope(namespace: str, system_prompt: str, max_tokens: int) -> str:
+    """Semantic matches only count within one namespace, model, embedding space and reply cap"""
+    return get_llm_cache_key(f"{EMBEDDING_MODEL}\x00{namespace}", system_prompt, max_tokens=max_tokens)
+
+async def get_semantic_cached_response(
+    semantic_key: Tuple[str, str],
+    system_prompt: str,
+    max_tokens: int
+) -> Optional[str]:
+    """Reuse the response to a near-duplicate question (cosine similarity above the threshold)"""
+    if not LLM_SEMANTIC_CACHE_ENABLED:
+        return None
+    
+    namespace, text = semantic_key
+    try:
+        query_vec = await embed_batcher.embed(text)
+        candidates = await get_database()["llm_semantic_cache"].find(
+            {"scope": get_semantic_cache_scope(namespace, system_prompt, max_tokens)},
+            projection={"_id": 0, "embedding": 1, "response": 1}
+        ).sort("created_at", -1).limit(LLM_SEMANTIC_CACHE_CANDIDATES).to_list(LLM_SEMANTIC_CACHE_CANDIDATES)
+    except Exception as e:
+        logger.warning(f"⚠️  Semantic LLM cache lookup failed: {str(e)}")
+        return None
+    
+    if not candidates:
+        return None
+    
+    # Embeddings are stored L2-normalized, so a dot product is the cosine similarity
+    matrix = np.frombuffer(b"".join(c["embedding"] for c in candidates), dtype=np.float32)
+    scores = matrix.reshape(len(candidates), -1) @ query_vec
+    best = int(np.argmax(scores))
+    if scores[best] < LLM_SEMANTIC_CACHE_MIN_SCORE:
+        return None
+    
+    logger.info(f"⚡ Semantic LLM cache hit (similarity {scores[best]:.3f})")
+    return candidates[best]["response"]
+
+async def cache_semantic_response(
+    semantic_key: Tuple[str, str],
+    system_prompt: str,
+    max_tokens: int,
+    response: str
+) -> None:
+    """Store a response under its question's embedding for near-duplicate reuse"""
+    if not LLM_SEMANTIC_CACHE_ENABLED:
+        return
+    
+    namespace, text = semantic_key
+    try:
+        query_vec = await embed_batcher.embed(text)
+        await get_unjournaled_collection("llm_semantic_cache").insert_one({
+            "scope": get_semantic_cache_scope(namespace, system_prompt, max_tokens),
+            "embedding": query_vec.astype(np.float32).tobytes(),
+            "response": response,
+            "created_at": datetime.utcnow()
+        })
+    except Exception as e:
+        logger.warning(f"⚠️  Semantic LLM cache write failed: {str(e)}")
+
+def get_llm_headers() -> Dict[str, str]:
+    """Default headers for every OpenRouter request"""
+    return {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "HTTP-Referer": "http://localhost:3000",
+        "X-Title": "BeyondChats Teacher Assistant",
+        "Content-Type": "application/json"
+    }
+
+def get_llm_payload(
+    prompt: str,
+    system_prompt: str,
+    stream: bool = False,
+    response_format: Optional[Dict[str, Any]] = None,
+    max_tokens: int = LLM_MAX_TOKENS
+) -> Dict[str, Any]:
+    """Chat completion request body"""
+    payload = {
+        "model": MODEL_NAME,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": LLM_TEMPERATURE,
+        "max_tokens": max_tokens
+    }
+    if stream:
+        payload["stream"] = True
+    if response_format:
+        payload["response_format"] = response_format
+    return payload
+
+async def call_llm(
+    prompt: str,
+    system_prompt: str = "You are a helpful AI assistant.",
+    use_fallback: bool = True,
+    semantic_key: Optional[Tuple[str, str]] = None,
+    response_format: Optional[Dict[str, Any]] = None,
+    max_tokens: int = LLM_MAX_TOKENS,
+    validate: Optional[Callable[[str], Any]] = None
+) -> str:
+    """Call OpenRouter API with improved error handling and fallback
+
+    semantic_key is an optional (namespace, question) pair; when given, a cached answer
+    to a near-duplicate question in the same namespace is reused. response_format is
+    only sent when LLM_JSON_MODE is on. max_tokens caps the completion length. validate,
+    when given, is run on a fresh reply; replies it raises on are returned but not cached.
+    """
+    if not LLM_JSON_MODE:
+        response_format = None
     
     # Check if API key is configured
     if not OPENROUTER_API_KEY or OPENROUTER_API_KEY == "your_key_here":
-        print("⚠️  OpenRouter API key not configured. Using fallback response.")
+        logger.warning("⚠️  OpenRouter API key not configured. Using fallback response.")
         if use_fallback:
             return get_fallback_response(prompt, system_prompt)
         else:
@@ -229,69 +680,114 @@ async def call_llm(prompt: str, system_prompt: str = "You are a helpful AI assis
                 detail="AI service not configured. Please set OPENROUTER_API_KEY in environment variables."
             )
     
+    cache_key = get_llm_cache_key(prompt, system_prompt, response_format, max_tokens)
+    cached = await get_cached_llm_response(cache_key)
+    if cached is None and semantic_key is not None:
+        cached = await get_semantic_cached_response(semantic_key, system_prompt, max_tokens)
+    if cached is not None:
+        logger.info("⚡ LLM cache hit")
+        return cached
+    
+    inflight_key = (cache_key, use_fallback)
+    inflight = llm_inflight.get(inflight_key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(request_llm(
+            prompt, system_prompt, use_fallback, cache_key, semantic_key, response_format, max_tokens, validate
+        ))
+        llm_inflight[inflight_key] = inflight
+        inflight.add_done_callback(lambda _: llm_inflight.pop(inflight_key, None))
+    else:
+        logger.info("🔗 Joining identical in-flight LLM call")
+    
+    # Shielded so one caller disconnecting doesn't cancel the completion for the others
+    return await asyncio.shield(inflight)
+
+async def request_llm(
+    prompt: str,
+    system_prompt: str,
+    use_fallback: bool,
+    cache_key: str,
+    semantic_key: Optional[Tuple[str, str]],
+    response_format: Optional[Dict[str, Any]],
+    max_tokens: int,
+    validate: Optional[Callable[[str], Any]]
+) -> str:
+    """Send one completion request to OpenRouter and cache a successful response"""
     try:
-        print(f"🤖 Calling LLM API with model: {MODEL_NAME}")
+        logger.info(f"🤖 Calling LLM API with model: {MODEL_NAME}")
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                f"{OPENROUTER_BASE_URL}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "HTTP-Referer": "http://localhost:3000",
-                    "X-Title": "BeyondChats Teacher Assistant",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": MODEL_NAME,
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 1000
-                }
-            )
-            
-            # Log response status
-            print(f"📡 API Response Status: {response.status_code}")
-            
-            if response.status_code == 401:
-                print("❌ Invalid API Key")
-                if use_fallback:
-                    return get_fallback_response(prompt, system_prompt)
-                raise HTTPException(status_code=503, detail="Invalid API key")
-            
-            if response.status_code == 429:
-                print("⚠️  Rate limit exceeded")
-                if use_fallback:
-                    return get_fallback_response(prompt, system_prompt)
-                raise HTTPException(status_code=503, detail="API rate limit exceeded")
-            
-            response.raise_for_status()
-            data = response.json()
+        # Cut off long-tail requests and re-issue them rather than waiting, allowing
+        # long completions the time they need to generate
+        timeout = max(LLM_TIMEOUT_SECONDS, max_tokens / LLM_MIN_TOKENS_PER_SECOND)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with llm_semaphore:
+                    response = await asyncio.wait_for(
+                        llm_client.post(
+                            "/chat/completions",
+                            json=get_llm_payload(
+                                prompt, system_prompt, response_format=response_format, max_tokens=max_tokens
+                            )
+                        ),
+                        timeout=timeout
+                    )
+                break
+            except asyncio.TimeoutError:
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                logger.info(f"⏱️  LLM call exceeded {timeout:.0f}s, retrying ({attempt + 1}/{LLM_MAX_RETRIES})")
+        
+        # Log response status
+        logger.info(f"📡 API Response Status: {response.status_code}")
+        
+        if response.status_code == 401:
+            logger.error("❌ Invalid API Key")
+            if use_fallback:
+                return get_fallback_response(prompt, system_prompt)
+            raise HTTPException(status_code=503, detail="Invalid API key")
+        
+        if response.status_code == 429:
+            logger.warning("⚠️  Rate limit exceeded")
+            if use_fallback:
+                return get_fallback_response(prompt, system_prompt)
+            raise HTTPException(status_code=503, detail="API rate limit exceeded")
+        
+        response.raise_for_status()
+        data = response.json()
+        
+        # Extract content from response
+        if "choices" in data and len(data["choices"]) > 0:
+            content = data["choices"][0]["message"]["content"]
+            logger.info(f"✅ LLM Response received ({len(content)} chars)")
             
-            # Extract content from response
-            if "choices" in data and len(data["choices"]) > 0:
-                content = data["choices"][0]["message"]["content"]
-                print(f"✅ LLM Response received ({len(content)} chars)")
-                return content
-            else:
-                print("❌ Unexpected API response format")
-                if use_fallback:
-                    return get_fallback_response(prompt, system_prompt)
-                raise HTTPException(status_code=503, detail="Unexpected API response format")
+            # A malformed reply would otherwise be replayed to every retry until the TTL expires
+            if validate is not None:
+                try:
+                    validate(content)
+                except Exception as e:
+                    logger.warning(f"⚠️  Not caching unusable LLM response: {str(e)}")
+                    return content
             
+            await cache_llm_response(cache_key, content)
+            if semantic_key is not None:
+                await cache_semantic_response(semantic_key, system_prompt, max_tokens, content)
+            return content
+        else:
+            logger.error("❌ Unexpected API response format")
+            if use_fallback:
+                return get_fallback_response(prompt, system_prompt)
+            raise HTTPException(status_code=503, detail="Unexpected API response format")
+        
     except httpx.HTTPStatusError as e:
-        print(f"❌ LLM API HTTP Error: {e.response.status_code}")
-        print(f"Response: {e.response.text[:200]}")
+        logger.error(f"❌ LLM API HTTP Error: {e.response.status_code}: {e.response.text[:200]}")
         if use_fallback:
             return get_fallback_response(prompt, system_prompt)
         raise HTTPException(
             status_code=503,
             detail=f"AI service error: {e.response.status_code}"
         )
-    except httpx.TimeoutException:
-        print("❌ LLM API Timeout")
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        logger.error("❌ LLM API Timeout")
         if use_fallback:
             return get_fallback_response(prompt, system_prompt)
         raise HTTPException(
@@ -299,9 +795,7 @@ async def call_llm(prompt: str, system_prompt: str = "You are a helpful AI assis
             detail="AI service timeout. Please try again."
         )
     except Exception as e:
-        print(f"❌ LLM API Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ LLM API Error: {str(e)}")
         if use_fallback:
             return get_fallback_response(prompt, system_prompt)
         raise HTTPException(
@@ -309,11 +803,117 @@ async def call_llm(prompt: str, system_prompt: str = "You are a helpful AI assis
             detail="AI service unavailable"
         )
 
+async def call_llm_stream(
+    prompt: str,
+    system_prompt: str = "You are a helpful AI assistant.",
+    semantic_key: Optional[Tuple[str, str]] = None,
+    max_tokens: int = LLM_MAX_TOKENS
+) -> AsyncIterator[str]:
+    """Stream completion text deltas from OpenRouter, falling back to a canned response"""
+    
+    if not OPENROUTER_API_KEY or OPENROUTER_API_KEY == "your_key_here":
+        logger.warning("⚠️  OpenRouter API key not configured. Using fallback response.")
+        yield get_fallback_response(prompt, system_prompt)
+        return
+    
+    cache_key = get_llm_cache_key(prompt, system_prompt, max_tokens=max_tokens)
+    cached = await get_cached_llm_response(cache_key)
+    if cached is None and semantic_key is not None:
+        cached = await get_semantic_cached_response(semantic_key, system_prompt, max_tokens)
+    if cached is not None:
+        logger.info("⚡ LLM cache hit")
+        yield cached
+        return
+    
+    parts = []
+    try:
+        logger.info(f"🤖 Streaming LLM API with model: {MODEL_NAME}")
+        
+        async with llm_semaphore:
+            async with llm_client.stream(
+                "POST",
+                "/chat/completions",
+                json=get_llm_payload(prompt, system_prompt, stream=True, max_tokens=max_tokens)
+            ) as response:
+                logger.info(f"📡 API Response Status: {response.status_code}")
+                if response.status_code != 200:
+                    await response.aread()
+                    response.raise_for_status()
+                
+                async for line in response.aiter_lines():
+                    # SSE frames look like "data: {...}"; comments and blank lines are keep-alives
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    
+                    chunk = orjson.loads(data)
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+        
+        content = "".join(parts)
+        logger.info(f"✅ LLM stream finished ({len(content)} chars)")
+        if content:
+            # Shielded so a client disconnecting right at the end doesn't cancel the cache write
+            with anyio.CancelScope(shield=True):
+                await cache_llm_response(cache_key, content)
+                if semantic_key is not None:
+                    await cache_semantic_response(semantic_key, system_prompt, max_tokens, content)
+        
+    except Exception as e:
+        logger.error(f"❌ LLM stream error: {str(e)}")
+        # Only substitute the fallback if nothing has reached the client yet
+        if not parts:
+            yield get_fallback_response(prompt, system_prompt)
+
+def extract_json_array(response: str) -> str:
+    """Strip markdown fences and surrounding chatter from an LLM's JSON array reply"""
+    response = response.strip()
+    
+    # Remove markdown code blocks if present
+    if response.startswith('```'):
+        lines = response.split('\n')
+        response = '\n'.join(line for line in lines if not line.startswith('```'))
+        response = response.strip()
+    
+    # Find JSON array
+    if not response.startswith('['):
+        start = response.find('[')
+        end = response.rfind(']') + 1
+        if start != -1 and end > start:
+            response = response[start:end]
+    
+    return response
+
+# Each keyword group is one scan of the prompt rather than one scan per keyword
+FALLBACK_QUESTION_RE = re.compile(r"question|explain|what", re.IGNORECASE)
+FALLBACK_VIDEO_RE = re.compile(r"youtube|video", re.IGNORECASE)
+
+def parse_llm_json_list(response: str, key: str) -> Any:
+    """Read the list from a JSON-mode reply ({key: [...]}), else salvage a bare array"""
+    try:
+        data = orjson.loads(response)
+        if isinstance(data, dict) and isinstance(data.get(key), list):
+            return data[key]
+        if isinstance(data, list):
+            return data
+    except orjson.JSONDecodeError:
+        pass
+    
+    return orjson.loads(extract_json_array(response))
+
 def get_fallback_response(prompt: str, system_prompt: str) -> str:
     """Generate intelligent fallback responses based on context"""
+    prompt_lower = prompt.lower()
     
     # Detect if this is a chat/question
-    if "question" in prompt.lower() or "explain" in prompt.lower() or "what" in prompt.lower():
+    if FALLBACK_QUESTION_RE.search(prompt):
         return """I understand you have a question, but I'm currently running in fallback mode without access to the AI service. 
 
 To get full AI-powered responses, please:
@@ -330,8 +930,8 @@ In the meantime, I can still help you with:
 What would you like to do?"""
     
     # Detect if this is quiz generation
-    if "generate" in prompt.lower() and "quiz" in prompt.lower():
-        return json.dumps([
+    if "generate" in prompt_lower and "quiz" in prompt_lower:
+        return orjson.dumps([
             {
                 "question": "What is the fundamental principle discussed in the material?",
                 "question_type": "SAQ",
@@ -339,15 +939,15 @@ What would you like to do?"""
                 "correct_answer": "Please refer to the study material for the correct answer",
                 "explanation": "This is a template question. Connect the AI service for personalized questions."
             }
-        ])
+        ]).decode()
     
     # Detect if this is YouTube recommendation
-    if "youtube" in prompt.lower() or "video" in prompt.lower():
+    if FALLBACK_VIDEO_RE.search(prompt):
         topic = "this topic"
         if ":" in prompt:
             topic = prompt.split(":")[-1].strip()[:50]
         
-        return json.dumps([
+        return orjson.dumps([
             {
                 "title": f"Introduction to {topic}",
                 "channel": "Khan Academy",
@@ -363,45 +963,407 @@ What would you like to do?"""
                 "channel": "Physics Wallah",
                 "reason": "Real-world examples and problem-solving techniques"
             }
-        ])
+        ]).decode()
     
     # Default fallback
     return "I'm currently operating in fallback mode. Please configure the OPENROUTER_API_KEY to enable full AI capabilities."
 
-def find_citations(query: str, pages_text: Dict[str, str], top_k: int = 3) -> List[Dict]:
-    """Simple keyword-based citation search"""
-    citations = []
-    query_words = set(query.lower().split())
+# An option label at the start of an answer: "b", "B)", "c. Mitochondria", "d: ..."
+MCQ_LETTER_RE = re.compile(r"([a-z])(?:[).:]|$)")
+# An answer that is nothing but an option label: "b", "B)", "c.", "d:"
+MCQ_BARE_LABEL_RE = re.compile(r"([a-z])[).:]?")
+
+def normalize_answer(answer: str) -> str:
+    return answer.strip().lower()
+
+def get_answer_letter(answer_norm: str) -> Optional[str]:
+    match = MCQ_LETTER_RE.match(answer_norm)
+    return match.group(1) if match else None
+
+def build_answer_key(question: QuizQuestion) -> Dict[str, Any]:
+    """Stored form of a question, with its answer pre-normalized for grading"""
+    correct_norm = normalize_answer(question.correct_answer)
+    return {
+        # Questions are flat models, so __dict__ already has the stored shape
+        **question.__dict__,
+        "correct_answer_norm": correct_norm,
+        "correct_letter": get_answer_letter(correct_norm) if question.question_type == "MCQ" else None
+    }
+
+def grade_answer(user_answer: str, question: Dict[str, Any]) -> bool:
+    """Case-insensitive match; MCQs also accept a bare option label ("B", "b)")"""
+    user_norm = normalize_answer(user_answer)
+    # Quizzes created before answers were pre-normalized
+    correct_norm = question.get("correct_answer_norm") or normalize_answer(question["correct_answer"])
+    if user_norm == correct_norm:
+        return True
+    # A label followed by option text must match in full above, so "a) Rome" can't pass for "A) Paris"
+    correct_letter = question.get("correct_letter")
+    label = MCQ_BARE_LABEL_RE.fullmatch(user_norm)
+    return correct_letter is not None and label is not None and label.group(1) == correct_letter
+
+def build_attempt_results(questions: List[Dict], user_answers: List[str], is_correct: List[bool]) -> List[Dict]:
+    """Join stored attempt answers back onto their quiz questions"""
+    return [
+        {
+            "question_index": idx,
+            "question": question["question"],
+            "user_answer": user_answer,
+            "correct_answer": question["correct_answer"],
+            "is_correct": correct,
+            "explanation": question["explanation"]
+        }
+        for idx, (question, user_answer, correct) in enumerate(zip(questions, user_answers, is_correct))
+    ]
+
+# ============================================================================
+# CITATION INDEX
+# ============================================================================
+# A run of text up to and including its terminal punctuation (or end of page)
+SENTENCE_RE = re.compile(r"[^.!?]+(?:[.!?]+|$)")
+CITATION_SHORTLIST_FACTOR = 8
+SEMANTIC_CITATION_MIN_SCORE = 0.3
+MIN_CITATION_SENTENCE_CHARS = 20  # Shorter fragments (headings, page numbers) make poor citations
+CITATION_SNIPPET_CHARS = 200
+
+def get_citation_index_path(pdf_id: ObjectId) -> str:
+    """Sidecar file holding a PDF's pickled citation index"""
+    return os.path.join(UPLOAD_DIR, f"{pdf_id}.citations.pkl")
+
+def build_citation_index(pages_text: Dict[str, str]) -> Dict[str, Any]:
+    """Fit a TF-IDF matrix over every sentence of a PDF (rows are L2-normalized)
+
+    The matrix is stored column-major (CSC), so each term's column is its postings
+    list: the ids and weights of the sentences containing it. Citation snippets are
+    cut once here so queries only rank and look them up.
+    """
+    sentences = []
+    sentence_pages = []
     
     for page_num, text in pages_text.items():
-        text_lower = text.lower()
-        matches = sum(1 for word in query_words if word in text_lower)
+        for match in SENTENCE_RE.finditer(text):
+            sentence = match.group().strip()
+            if len(sentence) >= MIN_CITATION_SENTENCE_CHARS:
+                sentences.append(sentence)
+                sentence_pages.append(int(page_num))
+    
+    # float32 weights halve the postings memory the query path streams through
+    vectorizer = TfidfVectorizer(
+        lowercase=True, sublinear_tf=True, ngram_range=(1, 2), stop_words="english", dtype=np.float32
+    )
+    try:
+        matrix = vectorizer.fit_transform(sentences).tocsc()
+    except ValueError:
+        # No sentences or no tokens to build a vocabulary from
+        matrix = None
+    
+    return {
+        "vectorizer": vectorizer,
+        "matrix": matrix,
+        "sentences": sentences,
+        **pack_snippets([make_snippet(sentence) for sentence in sentences]),
+        "pages": np.array(sentence_pages, dtype=np.int32)
+    }
+
+def pack_snippets(snippets: List[str]) -> Dict[str, Any]:
+    """Store snippets as one string plus offsets instead of thousands of small str objects"""
+    offsets = np.zeros(len(snippets) + 1, dtype=np.int64)
+    np.cumsum([len(snippet) for snippet in snippets], out=offsets[1:])
+    return {"snippet_blob": "".join(snippets), "snippet_offsets": offsets}
+
+def get_snippet(index: Dict[str, Any], idx: int) -> str:
+    offsets = index["snippet_offsets"]
+    return index["snippet_blob"][offsets[idx]:offsets[idx + 1]]
+
+def make_snippet(sentence: str) -> str:
+    return sentence[:CITATION_SNIPPET_CHARS] + "..." if len(sentence) > CITATION_SNIPPET_CHARS else sentence
+
+def get_ann_index_path(pdf_id: ObjectId) -> str:
+    """Sidecar file holding a PDF's HNSW sentence-embedding index"""
+    return os.path.join(UPLOAD_DIR, f"{pdf_id}.ann.bin")
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_model() -> Any:
+    """Load the local sentence embedding model once per process"""
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed texts as L2-normalized float32 vectors"""
+    return get_embedding_model().encode(
+        texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True
+    ).astype(np.float32)
+
+EMBED_BATCH_MAX = 32
+EMBED_BATCH_WINDOW_SECONDS = 0.005
+
+class EmbedBatcher:
+    """Coalesces concurrent query embeddings into one encode() call on a worker thread"""
+    
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        # Repeated questions skip the model entirely
+        self.cache: LRUCache = LRUCache(maxsize=QUERY_CACHE_SIZE)
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+    
+    async def embed(self, text: str) -> np.ndarray:
+        cached = self.cache.get(text)
+        if cached is not None:
+            return cached
+        
+        if self.task is None:
+            vector = (await asyncio.to_thread(embed_texts, [text]))[0]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((text, future))
+            vector = await future
         
-        if matches > 0:
-            sentences = text.split('.')
-            best_sentence = ""
-            max_matches = 0
+        self.cache[text] = vector
+        return vector
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
             
-            for sentence in sentences[:10]:
-                sent_matches = sum(1 for word in query_words if word in sentence.lower())
-                if sent_matches > max_matches:
-                    max_matches = sent_matches
-                    best_sentence = sentence.strip()
+            deadline = loop.time() + EMBED_BATCH_WINDOW_SECONDS
+            while len(batch) < EMBED_BATCH_MAX:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            texts = [text for text, _ in batch]
+            try:
+                vectors = await asyncio.to_thread(embed_texts, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
             
-            if best_sentence:
-                citations.append({
-                    "page": int(page_num) if page_num.isdigit() else page_num,
-                    "snippet": best_sentence[:200] + "..." if len(best_sentence) > 200 else best_sentence,
-                    "relevance": matches
-                })
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+embed_batcher = EmbedBatcher()
+
+def get_embeddings_path(pdf_id: ObjectId) -> str:
+    """Sidecar file holding a PDF's sentence embedding matrix"""
+    return os.path.join(UPLOAD_DIR, f"{pdf_id}.emb.npy")
+
+def get_sidecar_paths(pdf_id: ObjectId) -> Tuple[str, str, str]:
+    """Every derived file stored next to a PDF"""
+    return get_citation_index_path(pdf_id), get_ann_index_path(pdf_id), get_embeddings_path(pdf_id)
+
+def build_embedding_indexes(sentences: List[str], pdf_id: ObjectId) -> int:
+    """Embed every sentence, saving the matrix (and an HNSW index if available); returns the embedding size"""
+    vectors = embed_texts(sentences)
     
-    citations.sort(key=lambda x: x["relevance"], reverse=True)
-    return citations[:top_k]
+    embeddings_path = get_embeddings_path(pdf_id)
+    tmp_path = f"{embeddings_path}.tmp.npy"
+    np.save(tmp_path, vectors)
+    os.replace(tmp_path, embeddings_path)
+    
+    if hnswlib is not None:
+        build_ann_index(vectors, get_ann_index_path(pdf_id))
+    return vectors.shape[1]
+
+def build_ann_index(vectors: np.ndarray, ann_path: str) -> None:
+    """Build an HNSW index over sentence embeddings and save it at ann_path"""
+    ann = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+    ann.init_index(max_elements=len(vectors), ef_construction=200, M=16)
+    ann.add_items(vectors, np.arange(len(vectors)))
+    tmp_path = f"{ann_path}.tmp"
+    ann.save_index(tmp_path)
+    os.replace(tmp_path, ann_path)
+
+def save_citation_index(pages_text: Dict[str, str], pdf_id: ObjectId) -> None:
+    """Build a citation index and pickle it next to the PDF (runs in the extraction pool)"""
+    index = build_citation_index(pages_text)
+    # Full sentences are only needed to build the indexes; queries read the snippets
+    sentences = index.pop("sentences")
+    if SEMANTIC_SEARCH_ENABLED and sentences:
+        # Semantic search is an extra; without it (e.g. the model can't be loaded) chat uses TF-IDF
+        try:
+            index["embedding_dim"] = build_embedding_indexes(sentences, pdf_id)
+        except Exception as e:
+            logger.warning(f"⚠️  Semantic index build failed, using TF-IDF citations: {str(e)}")
+    
+    index_path = get_citation_index_path(pdf_id)
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+
+@functools.lru_cache(maxsize=32)
+def read_citation_index(pdf_id: ObjectId) -> Dict[str, Any]:
+    """Unpickle a citation index, memoized so repeat chats on a PDF skip the disk"""
+    with open(get_citation_index_path(pdf_id), "rb") as f:
+        index = pickle.load(f)
+    
+    # Older sidecars hold a list of snippets, or full sentences
+    if "snippet_blob" not in index:
+        snippets = index.pop("snippets", None)
+        if snippets is None:
+            snippets = [make_snippet(sentence) for sentence in index.pop("sentences")]
+        index.update(pack_snippets(snippets))
+        index["pages"] = index["pages"].astype(np.int32)
+    
+    # Sidecars written before postings-based scoring hold a float64 CSR matrix
+    if index["matrix"] is not None and index["matrix"].format != "csc":
+        index["matrix"] = index["matrix"].tocsc()
+    if index["matrix"] is not None and index["matrix"].dtype != np.float32:
+        index["matrix"] = index["matrix"].astype(np.float32)
+    
+    ann_path = get_ann_index_path(pdf_id)
+    embeddings_path = get_embeddings_path(pdf_id)
+    if index.get("embedding_dim") and hnswlib is not None and os.path.exists(ann_path):
+        ann = hnswlib.Index(space="cosine", dim=index["embedding_dim"])
+        ann.load_index(ann_path, max_elements=len(index["pages"]))
+        ann.set_ef(64)
+        index["ann"] = ann
+    elif index.get("embedding_dim") and os.path.exists(embeddings_path):
+        # Memory-mapped, so the OS page cache holds the matrix rather than each worker's heap
+        index["embeddings"] = np.load(embeddings_path, mmap_mode="r")
+    
+    index["query_cache"] = LRUCache(maxsize=PDF_QUERY_CACHE_SIZE)
+    return index
+
+async def load_citation_index(pdf_id: ObjectId) -> Optional[Dict[str, Any]]:
+    """Load a PDF's citation index, building it on first use for older uploads"""
+    if not os.path.exists(get_citation_index_path(pdf_id)):
+        pages_text = await get_pages_text(pdf_id)
+        if not pages_text:
+            return None
+        await asyncio.get_running_loop().run_in_executor(extract_pool, save_citation_index, pages_text, pdf_id)
+    
+    return await asyncio.to_thread(read_citation_index, pdf_id)
+
+async def search_citations(query: str, index: Dict[str, Any], top_k: int = 3) -> List[Dict]:
+    """Semantic search when the PDF has embeddings (ANN, else exact), TF-IDF otherwise"""
+    if index.get("ann") is None and index.get("embeddings") is None:
+        return find_citations(query, index, top_k)
+    
+    try:
+        query_vec = await embed_batcher.embed(query)
+    except Exception as e:
+        logger.warning(f"⚠️  Query embedding failed, using TF-IDF citations: {str(e)}")
+        return find_citations(query, index, top_k)
+    if index.get("ann") is not None:
+        return find_citations_semantic(query_vec, index, top_k)
+    return find_citations_exact(query_vec, index, top_k)
+
+def find_citations_semantic(query_vec: np.ndarray, index: Dict[str, Any], top_k: int = 3) -> List[Dict]:
+    """Approximate nearest-neighbour citation search over sentence embeddings"""
+    k = min(top_k * CITATION_SHORTLIST_FACTOR, len(index["pages"]))
+    labels, distances = index["ann"].knn_query(query_vec, k=k)
+    scores = 1.0 - distances[0]
+    
+    # knn always returns k neighbours; drop the ones that aren't actually related
+    keep = scores >= SEMANTIC_CITATION_MIN_SCORE
+    return collect_citations(labels[0][keep], scores[keep], index, top_k)
+
+def find_citations_exact(query_vec: np.ndarray, index: Dict[str, Any], top_k: int = 3) -> List[Dict]:
+    """Exact cosine search: rows and query are L2-normalized, so one float32 mat-vec scores every sentence"""
+    scores = index["embeddings"] @ query_vec
+    
+    candidates = np.flatnonzero(scores >= SEMANTIC_CITATION_MIN_SCORE)
+    shortlist = top_k * CITATION_SHORTLIST_FACTOR
+    if candidates.size > shortlist:
+        candidates = candidates[np.argpartition(-scores[candidates], shortlist)[:shortlist]]
+    
+    ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return collect_citations(ranked, scores[ranked], index, top_k)
+
+def transform_query(index: Dict[str, Any], query: str) -> Any:
+    """Vectorize a chat question against a PDF's vocabulary, memoized on the index so it's freed with it"""
+    cache = index["query_cache"]
+    query_vec = cache.get(query)
+    if query_vec is None:
+        query_vec = index["vectorizer"].transform([query])
+        cache[query] = query_vec
+    return query_vec
+
+def find_citations(query: str, index: Dict[str, Any], top_k: int = 3) -> List[Dict]:
+    """TF-IDF citation search: merge the postings of the query's terms into cosine scores"""
+    matrix = index["matrix"]
+    if matrix is None:
+        return []
+    
+    query_vec = transform_query(index, query)
+    if query_vec.nnz == 0:
+        # No query term occurs anywhere in the PDF
+        return []
+    
+    # Only sentences sharing a term with the query are touched, however long the PDF is
+    row_ids = []
+    weights = []
+    for term, query_weight in zip(query_vec.indices, query_vec.data):
+        start, end = matrix.indptr[term], matrix.indptr[term + 1]
+        row_ids.append(matrix.indices[start:end])
+        weights.append(matrix.data[start:end] * query_weight)
+    
+    candidates, inverse = np.unique(np.concatenate(row_ids), return_inverse=True)
+    if candidates.size == 0:
+        return []
+    # Scores line up with candidates, so nothing proportional to the PDF's sentence count is allocated
+    scores = np.bincount(inverse, weights=np.concatenate(weights))
+    
+    # Partially select a few times top_k so the one-per-page filter below has enough to pick from
+    shortlist = top_k * CITATION_SHORTLIST_FACTOR
+    if candidates.size > shortlist:
+        keep = np.argpartition(-scores, shortlist)[:shortlist]
+        candidates, scores = candidates[keep], scores[keep]
+    
+    order = np.argsort(-scores, kind="stable")
+    return collect_citations(candidates[order], scores[order], index, top_k)
+
+def collect_citations(ranked: np.ndarray, scores: np.ndarray, index: Dict[str, Any], top_k: int) -> List[Dict]:
+    """Turn best-first sentence ids into citations, keeping the top sentence from each page"""
+    citations = []
+    seen_pages = set()
+    
+    for idx, score in zip(ranked, scores):
+        page = int(index["pages"][idx])
+        if page in seen_pages:
+            continue
+        seen_pages.add(page)
+        
+        citations.append({
+            "page": page,
+            "snippet": get_snippet(index, idx),
+            "relevance": round(float(score), 3)
+        })
+        if len(citations) == top_k:
+            break
+    
+    return citations
 
 # ============================================================================
 # FASTAPI APP
 # ============================================================================
-app = FastAPI(title="BeyondChats Backend", version="1.0.0")
+def orjson_default(obj: Any) -> Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+class MongoJSONResponse(ORJSONResponse):
+    """Serializes Mongo documents as-is; returned directly to skip FastAPI's jsonable_encoder pass"""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(title="BeyondChats Backend", version="1.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -413,27 +1375,60 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup_event():
+    global extract_pool, llm_client, llm_warmup_task
     await connect_db()
+    # OpenRouter speaks HTTP/2, so concurrent calls multiplex over one connection
+    llm_client = httpx.AsyncClient(
+        base_url=OPENROUTER_BASE_URL,
+        headers=get_llm_headers(),
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=50,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+        )
+    )
+    if OPENROUTER_API_KEY and OPENROUTER_API_KEY != "your_key_here":
+        llm_warmup_task = asyncio.create_task(warm_llm_connection())
+    # "spawn" keeps workers clear of the motor threads and event loop in this process
+    extract_pool = ProcessPoolExecutor(
+        max_workers=EXTRACT_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+    youtube_batcher.start()
+    if SEMANTIC_SEARCH_ENABLED:
+        embed_batcher.start()
     
-    print("\n" + "="*60)
-    print("🚀 BeyondChats Backend Starting...")
-    print("="*60)
-    print(f"🗄️  Database: {DATABASE_NAME}")
-    print(f"📁 Upload Directory: {UPLOAD_DIR}")
-    print(f"🤖 AI Model: {MODEL_NAME}")
+    logger.info("="*60)
+    logger.info("🚀 BeyondChats Backend Starting...")
+    logger.info("="*60)
+    logger.info(f"🗄️  Database: {DATABASE_NAME}")
+    logger.info(f"📁 Upload Directory: {UPLOAD_DIR}")
+    logger.info(f"⚙️  PDF Extraction Workers: {EXTRACT_WORKERS}")
+    if SEMANTIC_SEARCH_ENABLED:
+        search_mode = "HNSW" if hnswlib is not None else "exact"
+        logger.info(f"🧭 Citation Search: semantic, {search_mode} ({EMBEDDING_MODEL})")
+    else:
+        logger.info("🧭 Citation Search: TF-IDF (pip install sentence-transformers hnswlib for semantic)")
+    logger.info(f"🤖 AI Model: {MODEL_NAME}")
     
     if not OPENROUTER_API_KEY or OPENROUTER_API_KEY == "your_key_here":
-        print("⚠️  OpenRouter API Key: NOT SET")
-        print("   → Running in FALLBACK MODE")
-        print("   → Get free key: https://openrouter.ai/keys")
+        logger.warning("⚠️  OpenRouter API Key: NOT SET → running in FALLBACK MODE (get a free key: https://openrouter.ai/keys)")
     else:
-        print("✅ OpenRouter API Key: Configured")
+        logger.info("✅ OpenRouter API Key: Configured")
     
-    print("="*60 + "\n")
+    logger.info("="*60)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     await close_db()
+    if llm_client:
+        await llm_client.aclose()
+    await youtube_batcher.stop()
+    await embed_batcher.stop()
+    if extract_pool:
+        extract_pool.shutdown()
 
 # ============================================================================
 # HEALTH CHECK
@@ -464,22 +1459,25 @@ async def upload_pdf(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
     file_size = 0
-    pdf_id = str(ObjectId())
+    pdf_oid = ObjectId()
+    pdf_id = str(pdf_oid)
     file_path = os.path.join(UPLOAD_DIR, f"{pdf_id}.pdf")
     
     try:
-        with open(file_path, "wb") as buffer:
-            while chunk := await file.read(1024 * 1024):
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
                 file_size += len(chunk)
-                if file_size > 50 * 1024 * 1024:
-                    buffer.close()
-                    os.remove(file_path)
-                    raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
-                buffer.write(chunk)
+                if file_size > MAX_UPLOAD_SIZE:
+                    break
+                await buffer.write(chunk)
         
-        print(f"📥 Saved PDF: {file.filename} ({file_size / 1024:.2f} KB)")
+        if file_size > MAX_UPLOAD_SIZE:
+            os.remove(file_path)
+            raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
+        
+        logger.info(f"📥 Saved PDF: {file.filename} ({file_size / 1024:.2f} KB)")
         
-        pages_text = extract_text_from_pdf(file_path)
+        pages_text = await extract_text_from_pdf(file_path)
         
         if not pages_text:
             os.remove(file_path)
@@ -487,20 +1485,34 @@ async def upload_pdf(file: UploadFile = File(...)):
         
         has_real_text = any("[Image-based page" not in text for text in pages_text.values())
         
+        # Pages live in their own collection so the pdfs doc stays small
+        page_docs = [
+            {"pdf_id": pdf_oid, "page_num": int(page_num), "text_zstd": compress_text(text)}
+            for page_num, text in pages_text.items()
+        ]
+        pages = get_database()["pdf_pages"]
+        for i in range(0, len(page_docs), PAGE_INSERT_BATCH):
+            await pages.insert_many(page_docs[i:i + PAGE_INSERT_BATCH], ordered=False)
+        
+        # Precompute the citation index once so chat never re-scans page text
+        await asyncio.get_running_loop().run_in_executor(
+            extract_pool, save_citation_index, pages_text, pdf_oid
+        )
+        
         pdf_doc = {
-            "_id": ObjectId(pdf_id),
+            "_id": pdf_oid,
             "filename": file.filename,
             "file_path": file_path,
             "file_size": file_size,
             "total_pages": len(pages_text),
-            "pages_text": pages_text,
             "is_image_based": not has_real_text,
+            "leading_text": " ".join(pages_text.values())[:LEADING_TEXT_CHARS],
             "uploaded_at": datetime.utcnow()
         }
         
         await get_database()["pdfs"].insert_one(pdf_doc)
         
-        print(f"✅ Successfully processed PDF: {file.filename}")
+        logger.info(f"✅ Successfully processed PDF: {file.filename}")
         
         return {
             "pdf_id": pdf_id,
@@ -514,17 +1526,20 @@ async def upload_pdf(file: UploadFile = File(...)):
     except HTTPException:
         raise
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        print(f"❌ PDF upload error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        for path in (file_path, *get_sidecar_paths(pdf_oid)):
+            if os.path.exists(path):
+                os.remove(path)
+        await get_database()["pdf_pages"].delete_many({"pdf_id": pdf_oid})
+        logger.exception(f"❌ PDF upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"PDF processing failed: {str(e)}")
 
 @app.get("/api/pdf/list")
 async def list_pdfs():
     """Get list of all uploaded PDFs"""
-    pdfs = await get_database()["pdfs"].find({}).to_list(100)
+    pdfs = await get_database()["pdfs"].find(
+        {},
+        projection={"filename": 1, "total_pages": 1, "file_size": 1, "is_image_based": 1, "uploaded_at": 1}
+    ).sort("uploaded_at", -1).to_list(100)
     
     return {
         "pdfs": [
@@ -534,7 +1549,7 @@ async def list_pdfs():
                 "total_pages": pdf["total_pages"],
                 "file_size": pdf.get("file_size", 0),
                 "is_image_based": pdf.get("is_image_based", False),
-                "uploaded_at": pdf["uploaded_at"].isoformat()
+                "uploaded_at": pdf["uploaded_at"]
             }
             for pdf in pdfs
         ]
@@ -543,7 +1558,7 @@ async def list_pdfs():
 @app.get("/api/pdf/{pdf_id}")
 async def get_pdf(pdf_id: str):
     """Get PDF file"""
-    pdf = await get_database()["pdfs"].find_one({"_id": ObjectId(pdf_id)})
+    pdf = await get_database()["pdfs"].find_one({"_id": parse_oid(pdf_id)})
     
     if not pdf:
         raise HTTPException(status_code=404, detail="PDF not found")
@@ -553,60 +1568,56 @@ async def get_pdf(pdf_id: str):
 @app.get("/api/pdf/{pdf_id}/text")
 async def get_pdf_text(pdf_id: str):
     """Get extracted text from PDF"""
-    pdf = await get_database()["pdfs"].find_one({"_id": ObjectId(pdf_id)})
+    pdf = await get_database()["pdfs"].find_one({"_id": parse_oid(pdf_id)})
     
     if not pdf:
         raise HTTPException(status_code=404, detail="PDF not found")
     
     return {
         "pdf_id": pdf_id,
-        "pages_text": pdf["pages_text"],
+        "pages_text": await get_pages_text(pdf["_id"]),
         "is_image_based": pdf.get("is_image_based", False)
     }
 
 @app.delete("/api/pdf/{pdf_id}")
 async def delete_pdf(pdf_id: str):
     """Delete a PDF"""
-    pdf = await get_database()["pdfs"].find_one({"_id": ObjectId(pdf_id)})
+    database = get_database()
+    pdf = await database["pdfs"].find_one({"_id": parse_oid(pdf_id)})
     
     if not pdf:
         raise HTTPException(status_code=404, detail="PDF not found")
     
-    if os.path.exists(pdf["file_path"]):
-        os.remove(pdf["file_path"])
+    for path in (pdf["file_path"], *get_sidecar_paths(pdf["_id"])):
+        if os.path.exists(path):
+            os.remove(path)
     
-    await get_database()["pdfs"].delete_one({"_id": ObjectId(pdf_id)})
+    await database["pdfs"].delete_one({"_id": pdf["_id"]})
+    await database["pdf_pages"].delete_many({"pdf_id": pdf["_id"]})
     
     return {"message": "PDF deleted successfully"}
 
 # ============================================================================
 # QUIZ ROUTES
 # ============================================================================
-@app.post("/api/quiz/generate")
-async def generate_quiz(request: QuizGenerateRequest):
-    """Generate quiz questions from PDF"""
-    try:
-        if request.pdf_id:
-            pdf = await get_database()["pdfs"].find_one({"_id": ObjectId(request.pdf_id)})
-            if not pdf:
-                raise HTTPException(status_code=404, detail="PDF not found")
-            
-            if pdf.get("is_image_based", False):
-                raise HTTPException(status_code=422, detail="Cannot generate quiz from image-based PDF.")
-            
-            all_text = " ".join(pdf["pages_text"].values())
-            context = all_text[:4000]
-        else:
-            context = "General educational topics"
-        
-        prompt = f"""Based on the following content, generate quiz questions in STRICT JSON format:
+QUIZ_TYPE_DESCRIPTIONS = {
+    "MCQ": "Multiple Choice Questions (MCQ) with 4 options each",
+    "SAQ": "Short Answer Questions (SAQ)",
+    "LAQ": "Long Answer Questions (LAQ)"
+}
+# Completion budget per question, plus room for the JSON wrapper, so longer quizzes aren't truncated
+# and short ones can't ramble
+QUIZ_TOKENS_PER_QUESTION = {"MCQ": 150, "SAQ": 200, "LAQ": 400}
+QUIZ_TOKENS_OVERHEAD = 200
+
+async def generate_quiz_questions(context: str, question_type: str, count: int) -> List[QuizQuestion]:
+    """Generate questions of a single type; an unparseable response yields none"""
+    prompt = f"""Based on the following content, generate quiz questions in STRICT JSON format:
 
 Content: {context}
 
 Generate exactly:
-- {request.num_mcq} Multiple Choice Questions (MCQ) with 4 options each
-- {request.num_saq} Short Answer Questions (SAQ)
-- {request.num_laq} Long Answer Questions (LAQ)
+- {count} {QUIZ_TYPE_DESCRIPTIONS[question_type]}
 
 RESPOND ONLY WITH A JSON ARRAY IN THIS EXACT FORMAT:
 [
@@ -628,53 +1639,95 @@ RESPOND ONLY WITH A JSON ARRAY IN THIS EXACT FORMAT:
 
 IMPORTANT: Return ONLY the JSON array, no other text."""
 
-        system_prompt = "You are a quiz generator. Respond with ONLY valid JSON array, no markdown, no explanations."
-        
-        response = await call_llm(prompt, system_prompt, use_fallback=True)
-        
+    system_prompt = "You are a quiz generator. Respond with ONLY valid JSON array, no markdown, no explanations."
+    
+    response = await call_llm(
+        prompt, system_prompt, use_fallback=True, response_format=QUIZ_RESPONSE_FORMAT,
+        max_tokens=QUIZ_TOKENS_PER_QUESTION[question_type] * count + QUIZ_TOKENS_OVERHEAD,
+        validate=check_quiz_reply
+    )
+    
+    try:
+        questions, skipped = parse_quiz_questions(response)
+    except Exception as e:
+        logger.warning(f"⚠️  Failed to parse {question_type} LLM response: {e}")
+        logger.debug(f"Response was: {response[:500]}")
+        return []
+    
+    if skipped:
+        logger.warning(f"⚠️  Skipped {skipped} invalid {question_type} questions")
+    return questions
+
+def parse_quiz_questions(response: str) -> Tuple[List[QuizQuestion], int]:
+    """Parse a quiz reply into its valid questions and the number skipped; raises if it isn't JSON"""
+    # Clean replies are parsed and validated in one pass, without building intermediate dicts
+    try:
+        reply = QUIZ_REPLY_ADAPTER.validate_json(response)
+        return (reply.questions if isinstance(reply, QuizQuestionList) else reply), 0
+    except ValidationError:
+        pass
+    
+    questions_data = parse_llm_json_list(response, "questions")
+    
+    # Fenced or chatty replies: validate the salvaged list in one pass
+    try:
+        return QUIZ_QUESTIONS_ADAPTER.validate_python(questions_data), 0
+    except ValidationError:
+        pass
+    
+    # Only when something is invalid, go item by item to keep the good questions
+    validated_questions = []
+    for q in questions_data:
         try:
-            response = response.strip()
-            
-            # Remove markdown code blocks if present
-            if response.startswith('```'):
-                lines = response.split('\n')
-                response = '\n'.join(line for line in lines if not line.startswith('```'))
-                response = response.strip()
-            
-            # Find JSON array
-            if not response.startswith('['):
-                start = response.find('[')
-                end = response.rfind(']') + 1
-                if start != -1 and end > start:
-                    response = response[start:end]
-            
-            questions_data = json.loads(response)
-            
-            # Validate and clean questions
-            validated_questions = []
-            for q in questions_data:
-                try:
-                    validated_questions.append(QuizQuestion(**q))
-                except Exception as e:
-                    print(f"⚠️  Skipping invalid question: {e}")
-                    continue
-            
-            questions = validated_questions
+            validated_questions.append(QuizQuestion(**q))
+        except Exception:
+            continue
+    
+    return validated_questions, len(questions_data) - len(validated_questions)
+
+def check_quiz_reply(response: str) -> None:
+    """Cache guard: a quiz reply is only worth keeping if it yields at least one question"""
+    questions, _ = parse_quiz_questions(response)
+    if not questions:
+        raise ValueError("no valid questions")
+
+@app.post("/api/quiz/generate")
+async def generate_quiz(request: QuizGenerateRequest):
+    """Generate quiz questions from PDF"""
+    try:
+        if request.pdf_id:
+            pdf = await get_database()["pdfs"].find_one(
+                {"_id": parse_oid(request.pdf_id)},
+                projection={"is_image_based": 1, "leading_text": 1}
+            )
+            if not pdf:
+                raise HTTPException(status_code=404, detail="PDF not found")
             
-        except Exception as e:
-            print(f"⚠️  Failed to parse LLM response: {e}")
-            print(f"Response was: {response[:500]}")
+            if pdf.get("is_image_based", False):
+                raise HTTPException(status_code=422, detail="Cannot generate quiz from image-based PDF.")
             
-            # Fallback questions
-            questions = [
-                QuizQuestion(
-                    question="What is the main topic discussed in the material?",
-                    question_type="SAQ",
-                    options=None,
-                    correct_answer="Please refer to the study material",
-                    explanation="This is a template question. Configure AI service for personalized questions."
-                )
-            ]
+            context = pdf.get("leading_text")
+            if context is None:
+                # Uploaded before leading_text was stored
+                context = await get_leading_text(pdf["_id"], LEADING_TEXT_CHARS)
+        else:
+            context = "General educational topics"
+        
+        # One sub-prompt per question type, dispatched concurrently
+        counts = {"MCQ": request.num_mcq, "SAQ": request.num_saq, "LAQ": request.num_laq}
+        parts = await asyncio.gather(*(
+            generate_quiz_questions(context, question_type, count)
+            for question_type, count in counts.items() if count > 0
+        ))
+        
+        questions = []
+        seen = set()
+        for part in parts:
+            for q in part:
+                # Fallback mode returns the same template question for every part
+                if q.question not in seen:
+                    seen.add(q.question)
+                    questions.append(q)
         
         if not questions:
             questions = [
@@ -687,15 +1740,16 @@ IMPORTANT: Return ONLY the JSON array, no other text."""
                 )
             ]
         
-        quiz_id = str(ObjectId())
+        quiz_oid = ObjectId()
+        quiz_id = str(quiz_oid)
         quiz_doc = {
-            "_id": ObjectId(quiz_id),
+            "_id": quiz_oid,
             "pdf_id": request.pdf_id,
-            "questions": [q.model_dump() for q in questions],
+            "questions": [build_answer_key(q) for q in questions],
             "created_at": datetime.utcnow()
         }
         
-        await get_database()["quizzes"].insert_one(quiz_doc)
+        await get_unjournaled_collection("quizzes").insert_one(quiz_doc)
         
         return {
             "quiz_id": quiz_id,
@@ -705,215 +1759,382 @@ IMPORTANT: Return ONLY the JSON array, no other text."""
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Quiz generation error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Quiz generation error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Quiz generation failed: {str(e)}")
 
 @app.post("/api/quiz/submit")
 async def submit_quiz(request: QuizSubmitRequest):
     """Submit quiz answers"""
-    quiz = await get_database()["quizzes"].find_one({"_id": ObjectId(request.quiz_id)})
+    quiz = await get_database()["quizzes"].find_one(
+        {"_id": parse_oid(request.quiz_id)},
+        projection={"_id": 0, "questions": 1}
+    )
     
     if not quiz:
         raise HTTPException(status_code=404, detail="Quiz not found")
     
     questions = quiz["questions"]
-    results = []
-    correct_count = 0
-    
     answer_map = {ans.question_index: ans.user_answer for ans in request.answers}
     
-    for idx, question in enumerate(questions):
-        user_answer = answer_map.get(idx, "")
-        correct_answer = question["correct_answer"]
-        
-        is_correct = user_answer.strip().lower() == correct_answer.strip().lower()
-        
-        if is_correct:
-            correct_count += 1
-        
-        results.append({
-            "question_index": idx,
-            "question": question["question"],
-            "user_answer": user_answer,
-            "correct_answer": correct_answer,
-            "is_correct": is_correct,
-            "explanation": question["explanation"]
-        })
+    user_answers = [answer_map.get(idx, "") for idx in range(len(questions))]
+    is_correct = [grade_answer(user_answer, question) for user_answer, question in zip(user_answers, questions)]
     
+    correct_count = sum(is_correct)
     score_percentage = (correct_count / len(questions)) * 100 if questions else 0
     
+    # Only the per-question answers are stored; question text is joined back on read
     attempt_doc = {
         "quiz_id": request.quiz_id,
         "total_questions": len(questions),
         "correct_answers": correct_count,
         "score_percentage": score_percentage,
-        "results": results,
+        "user_answers": user_answers,
+        "is_correct": is_correct,
         "submitted_at": datetime.utcnow()
     }
     
-    await get_database()["attempts"].insert_one(attempt_doc)
+    result = await get_unjournaled_collection("attempts").insert_one(attempt_doc)
     
     return {
+        "attempt_id": str(result.inserted_id),
         "quiz_id": request.quiz_id,
         "total_questions": len(questions),
         "correct_answers": correct_count,
         "score_percentage": score_percentage,
-        "results": results
+        "results": build_attempt_results(questions, user_answers, is_correct)
+    }
+
+@app.get("/api/quiz/attempt/{attempt_id}")
+async def get_attempt(attempt_id: str):
+    """Get a quiz attempt with its per-question results"""
+    attempt = await get_database()["attempts"].find_one({"_id": parse_oid(attempt_id)})
+    
+    if not attempt:
+        raise HTTPException(status_code=404, detail="Attempt not found")
+    
+    # Attempts saved before answers were stored compactly carry full results
+    results = attempt.get("results")
+    if results is None:
+        quiz = await get_database()["quizzes"].find_one(
+            {"_id": parse_oid(attempt["quiz_id"])},
+            projection={"_id": 0, "questions": 1}
+        )
+        if not quiz:
+            raise HTTPException(status_code=404, detail="Quiz not found")
+        results = build_attempt_results(quiz["questions"], attempt["user_answers"], attempt["is_correct"])
+    
+    return {
+        "attempt_id": attempt_id,
+        "quiz_id": attempt["quiz_id"],
+        "total_questions": attempt["total_questions"],
+        "correct_answers": attempt["correct_answers"],
+        "score_percentage": attempt["score_percentage"],
+        "results": results,
+        "submitted_at": attempt["submitted_at"]
     }
 
 # ============================================================================
 # CHAT ROUTES 
 # ============================================================================
-@app.post("/api/chat")
-async def chat(request: ChatRequest):
-    """Chat with AI teacher"""
-    try:
-        print(f"💬 Chat request received: {request.message[:50]}...")
-        
-        # Get or create chat session
-        if request.chat_id:
-            chat_doc = await get_database()["chats"].find_one({"_id": ObjectId(request.chat_id)})
-            if not chat_doc:
-                raise HTTPException(status_code=404, detail="Chat not found")
-            messages = chat_doc.get("messages", [])
-            chat_id = request.chat_id
-        else:
-            chat_id = str(ObjectId())
-            messages = []
-        
-        # Find citations if PDF is provided
-        citations = []
-        context = ""
-        
-        if request.pdf_id:
-            try:
-                pdf = await get_database()["pdfs"].find_one({"_id": ObjectId(request.pdf_id)})
-                if pdf:
-                    pages_text = pdf["pages_text"]
-                    citations = find_citations(request.message, pages_text, top_k=3)
-                    
-                    if citations:
-                        context_parts = []
-                        for c in citations:
-                            context_parts.append(f"[Page {c['page']}]: {c['snippet']}")
-                        context = "\n\n".join(context_parts)
-                        print(f"📚 Found {len(citations)} relevant citations")
-            except Exception as e:
-                print(f"⚠️  Error finding citations: {e}")
-        
-        # Build prompt
-        if context:
-            prompt = f"""You are a helpful teacher. Answer the student's question based on these excerpts from their coursebook:
+CHAT_CONTEXT_MESSAGES = 20
+CHAT_MAX_STORED_MESSAGES = 200
+CHAT_HISTORY_TOKEN_BUDGET = 2000
+CHARS_PER_TOKEN = 4  # Rough estimate; close enough for budgeting without a model-specific tokenizer
+CHAT_MAX_TOKENS = 600  # Default reply cap; clients can ask for more or less per request
+FOLLOWUP_MAX_TOKENS = 150
+CHAT_SYSTEM_PROMPT = "You are a knowledgeable and patient teacher. Provide clear, educational responses that help students learn."
+
+def build_chat_history(messages: List[Dict], token_budget: int = CHAT_HISTORY_TOKEN_BUDGET) -> str:
+    """Render the most recent turns that fit in the token budget, oldest first"""
+    char_budget = token_budget * CHARS_PER_TOKEN
+    lines = []
+    
+    for message in reversed(messages):
+        speaker = "Student" if message.get("role") == "user" else "Teacher"
+        line = f"{speaker}: {message.get('content', '')}"
+        if len(line) > char_budget:
+            break
+        char_budget -= len(line) + 1
+        lines.append(line)
+    
+    return "\n".join(reversed(lines))
+
+async def prepare_chat(request: ChatRequest) -> Dict[str, Any]:
+    """Load the chat session and build the prompt with citations"""
+    # Get or create chat session
+    if request.chat_id:
+        chat_oid = parse_oid(request.chat_id)
+        # Only the recent turns are needed; long sessions would otherwise ship every message
+        chat_doc = await get_database()["chats"].find_one(
+            {"_id": chat_oid},
+            {"messages": {"$slice": -CHAT_CONTEXT_MESSAGES}}
+        )
+        if not chat_doc:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        messages = chat_doc.get("messages", [])
+        chat_id = request.chat_id
+    else:
+        chat_oid = ObjectId()
+        chat_id = str(chat_oid)
+        messages = []
+    
+    # Find citations if PDF is provided
+    citations = []
+    context = ""
+    
+    if request.pdf_id:
+        try:
+            index = await load_citation_index(parse_oid(request.pdf_id))
+            if index:
+                citations = await search_citations(request.message, index, top_k=3)
+                
+                if citations:
+                    context_parts = []
+                    for c in citations:
+                        context_parts.append(f"[Page {c['page']}]: {c['snippet']}")
+                    context = "\n\n".join(context_parts)
+                    logger.info(f"📚 Found {len(citations)} relevant citations")
+        except Exception as e:
+            logger.warning(f"⚠️  Error finding citations: {e}")
+    
+    # Build prompt
+    history = build_chat_history(messages)
+    history_block = f"Conversation so far:\n{history}\n\n" if history else ""
+    
+    if context:
+        prompt = f"""You are a helpful teacher. Answer the student's question based on these excerpts from their coursebook:
 
 {context}
 
-Student's question: {request.message}
+{history_block}Student's question: {request.message}
 
 Provide a clear, educational response. If the excerpts don't fully answer the question, use your knowledge but acknowledge this."""
-        else:
-            prompt = f"""You are a helpful teacher. Answer this student's question clearly and educationally:
+    else:
+        prompt = f"""You are a helpful teacher. Answer this student's question clearly and educationally:
 
-Question: {request.message}
+{history_block}Question: {request.message}
 
 Provide a thorough, helpful response."""
-        
-        system_prompt = "You are a knowledgeable and patient teacher. Provide clear, educational responses that help students learn."
-        
-        # Get AI response
-        response_text = await call_llm(prompt, system_prompt, use_fallback=True)
-        
-        print(f"✅ Chat response generated ({len(response_text)} chars)")
-        
-        # Save to database
-        messages.append({
+    
+    # Follow-ups depend on the conversation, so they're only matched against answers
+    # prefetched right after the reply they follow
+    if not history:
+        semantic_key = (f"chat:{request.pdf_id or ''}", request.message)
+    elif CHAT_PREFETCH_FOLLOWUPS:
+        semantic_key = (get_followup_namespace(chat_id, messages[-1]["content"]), request.message)
+    else:
+        semantic_key = None
+    
+    return {
+        "chat_oid": chat_oid,
+        "chat_id": chat_id,
+        "messages": messages,
+        "citations": citations,
+        "prompt": prompt,
+        "semantic_key": semantic_key,
+        "max_tokens": request.max_tokens or CHAT_MAX_TOKENS
+    }
+
+async def save_chat_turn(request: ChatRequest, session: Dict[str, Any], response_text: str):
+    """Append the user message and assistant reply to the chat session"""
+    now = datetime.utcnow()
+    new_messages = [
+        {
             "role": "user",
             "content": request.message,
-            "timestamp": datetime.utcnow()
-        })
-        
-        messages.append({
+            "timestamp": now
+        },
+        {
             "role": "assistant",
             "content": response_text,
-            "citations": citations,
-            "timestamp": datetime.utcnow()
-        })
-        
-        chat_doc = {
-            "_id": ObjectId(chat_id),
-            "pdf_id": request.pdf_id,
-            "messages": messages,
-            "last_message": request.message,
-            "updated_at": datetime.utcnow()
+            "citations": session["citations"],
+            "timestamp": now
         }
+    ]
+    
+    # Append rather than rewrite the array, keeping only the most recent messages;
+    # the upsert creates the session on its first turn
+    await get_database()["chats"].update_one(
+        {"_id": session["chat_oid"]},
+        {
+            "$push": {"messages": {"$each": new_messages, "$slice": -CHAT_MAX_STORED_MESSAGES}},
+            "$set": {
+                "pdf_id": request.pdf_id,
+                "last_message": request.message,
+                "updated_at": now
+            },
+            "$setOnInsert": {"created_at": now}
+        },
+        upsert=True
+    )
+    
+    if CHAT_PREFETCH_FOLLOWUPS:
+        task = asyncio.create_task(prefetch_followups(request, session["chat_id"], response_text))
+        prefetch_tasks.add(task)
+        task.add_done_callback(prefetch_tasks.discard)
+
+def get_followup_namespace(chat_id: str, reply: str) -> str:
+    """Semantic cache namespace for questions asked right after a given reply"""
+    return f"followup:{chat_id}:{hashlib.sha256(reply.encode('utf-8')).hexdigest()[:16]}"
+
+FOLLOWUP_SYSTEM_PROMPT = "You predict student questions. Respond with ONLY a valid JSON array of strings, no markdown."
+# Strong references so background prefetches aren't garbage collected mid-flight
+prefetch_tasks: set = set()
+
+async def prefetch_followups(request: ChatRequest, chat_id: str, reply: str):
+    """Answer the follow-ups a student is likely to ask next, warming the semantic cache"""
+    prompt = f"""A student asked: {request.message}
+
+The teacher replied: {reply[:2000]}
+
+Suggest {CHAT_PREFETCH_COUNT} short follow-up questions the student is most likely to ask next.
+
+RESPOND ONLY WITH A JSON ARRAY OF STRINGS."""
+    
+    try:
+        response = await call_llm(prompt, FOLLOWUP_SYSTEM_PROMPT, use_fallback=False, max_tokens=FOLLOWUP_MAX_TOKENS)
+        questions = [q for q in parse_llm_json_list(response, "questions") if isinstance(q, str) and q.strip()]
         
-        if request.chat_id:
-            await get_database()["chats"].update_one(
-                {"_id": ObjectId(chat_id)},
-                {"$set": chat_doc}
+        # One at a time, so prefetching never crowds out live requests on the LLM semaphore
+        for question in questions[:CHAT_PREFETCH_COUNT]:
+            followup = ChatRequest(message=question, chat_id=chat_id, pdf_id=request.pdf_id, max_tokens=request.max_tokens)
+            session = await prepare_chat(followup)
+            await call_llm(
+                session["prompt"], CHAT_SYSTEM_PROMPT, use_fallback=False,
+                semantic_key=session["semantic_key"], max_tokens=session["max_tokens"]
             )
-        else:
-            chat_doc["created_at"] = datetime.utcnow()
-            await get_database()["chats"].insert_one(chat_doc)
+        
+        logger.info(f"🔮 Prefetched {min(len(questions), CHAT_PREFETCH_COUNT)} follow-up answers")
+    except Exception as e:
+        logger.warning(f"⚠️  Follow-up prefetch failed: {str(e)}")
+
+@app.post("/api/chat")
+async def chat(request: ChatRequest):
+    """Chat with AI teacher"""
+    try:
+        logger.info(f"💬 Chat request received: {request.message[:50]}...")
+        
+        session = await prepare_chat(request)
+        
+        # Get AI response
+        response_text = await call_llm(
+            session["prompt"], CHAT_SYSTEM_PROMPT, use_fallback=True,
+            semantic_key=session["semantic_key"], max_tokens=session["max_tokens"]
+        )
+        
+        logger.info(f"✅ Chat response generated ({len(response_text)} chars)")
+        
+        # Save to database
+        await save_chat_turn(request, session, response_text)
         
         return {
-            "chat_id": chat_id,
+            "chat_id": session["chat_id"],
             "message": response_text,
-            "citations": citations
+            "citations": session["citations"]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Chat error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Chat failed: {str(e)}")
 
+def sse_event(payload: Dict[str, Any]) -> bytes:
+    """Encode one server-sent event"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat with AI teacher, streaming the reply as server-sent events"""
+    logger.info(f"💬 Streaming chat request received: {request.message[:50]}...")
+    
+    session = await prepare_chat(request)
+    
+    async def event_stream():
+        parts = []
+        try:
+            # Citations are known before generation starts, so send them up front
+            yield sse_event({
+                "chat_id": session["chat_id"],
+                "citations": session["citations"]
+            })
+            
+            async for delta in call_llm_stream(
+                session["prompt"], CHAT_SYSTEM_PROMPT,
+                semantic_key=session["semantic_key"], max_tokens=session["max_tokens"]
+            ):
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+            
+            yield sse_event({"done": True, "chat_id": session["chat_id"]})
+        finally:
+            # Persist whatever was generated, even if the client disconnected mid-stream;
+            # Starlette keeps cancelling the task after a disconnect, so the save is shielded
+            response_text = "".join(parts)
+            if response_text:
+                with anyio.CancelScope(shield=True):
+                    try:
+                        await save_chat_turn(request, session, response_text)
+                        logger.info(f"✅ Chat response streamed ({len(response_text)} chars)")
+                    except Exception as e:
+                        logger.error(f"❌ Failed to save streamed chat: {e}")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/chat/history")
 async def get_chat_history():
     """Get all chat sessions"""
     try:
-        chats = await get_database()["chats"].find({}).sort("updated_at", -1).to_list(100)
+        # Count messages server-side instead of shipping every conversation;
+        # the leading $sort/$limit walk the updated_at index instead of sorting in memory
+        chats = await get_database()["chats"].aggregate([
+            {"$sort": {"updated_at": -1}},
+            {"$limit": 100},
+            # Defaults are filled in server-side so each row is already in response shape
+            {"$project": {
+                "_id": 0,
+                "chat_id": "$_id",
+                "pdf_id": {"$ifNull": ["$pdf_id", None]},
+                "last_message": {"$ifNull": ["$last_message", ""]},
+                "message_count": {"$size": {"$ifNull": ["$messages", []]}},
+                "updated_at": {"$ifNull": ["$updated_at", "$created_at"]}
+            }}
+        ], hint={"updated_at": -1}).to_list(100)
         
-        return {
-            "chats": [
-                {
-                    "chat_id": str(chat["_id"]),
-                    "last_message": chat.get("last_message", ""),
-                    "message_count": len(chat.get("messages", [])),
-                    "updated_at": chat.get("updated_at", chat.get("created_at")).isoformat()
-                }
-                for chat in chats
-            ]
-        }
+        return MongoJSONResponse({"chats": chats})
     except Exception as e:
-        print(f"❌ Error fetching chat history: {str(e)}")
+        logger.error(f"❌ Error fetching chat history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chat/{chat_id}")
 async def get_chat(chat_id: str):
     """Get specific chat"""
     try:
-        chat = await get_database()["chats"].find_one({"_id": ObjectId(chat_id)})
+        chat = await get_database()["chats"].find_one({"_id": parse_oid(chat_id)}, projection={"messages": 1})
         
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         
-        return {
-            "chat_id": str(chat["_id"]),
+        # Long sessions hold up to CHAT_MAX_STORED_MESSAGES; orjson encodes them without a jsonable_encoder walk
+        return MongoJSONResponse({
+            "chat_id": chat["_id"],
             "messages": chat.get("messages", [])
-        }
+        })
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error fetching chat: {str(e)}")
+        logger.error(f"❌ Error fetching chat: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/api/chat/{chat_id}")
 async def delete_chat(chat_id: str):
     """Delete a chat"""
     try:
-        result = await get_database()["chats"].delete_one({"_id": ObjectId(chat_id)})
+        result = await get_database()["chats"].delete_one({"_id": parse_oid(chat_id)})
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Chat not found")
@@ -922,7 +2143,7 @@ async def delete_chat(chat_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error deleting chat: {str(e)}")
+        logger.error(f"❌ Error deleting chat: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ============================================================================
@@ -932,52 +2153,65 @@ async def delete_chat(chat_id: str):
 async def get_progress():
     """Get user progress statistics"""
     try:
-        attempts = await get_database()["attempts"].find({}).sort("submitted_at", -1).to_list(100)
+        attempts = get_database()["attempts"]
+        
+        # Totals are folded server-side; the recent list is a top-10 walk of the
+        # submitted_at index ($facet sub-pipelines can't use indexes)
+        totals, recent_attempts = await asyncio.gather(
+            attempts.aggregate([
+                {"$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "total_questions": {"$sum": "$total_questions"},
+                    "total_correct": {"$sum": "$correct_answers"},
+                    "avg_score": {"$avg": "$score_percentage"},
+                    "high": {"$sum": {"$cond": [{"$gte": ["$score_percentage", 80]}, 1, 0]}},
+                    "low": {"$sum": {"$cond": [{"$lt": ["$score_percentage", 60]}, 1, 0]}}
+                }}
+            ]).to_list(1),
+            attempts.aggregate([
+                {"$sort": {"submitted_at": -1}},
+                {"$limit": 10},
+                {"$project": {
+                    "_id": 0,
+                    "date": "$submitted_at",
+                    "score": "$score_percentage",
+                    "questions": "$total_questions"
+                }}
+            ], hint={"submitted_at": -1}).to_list(10)
+        )
         
-        if not attempts:
+        if not totals:
             return {
                 "total_quizzes": 0,
                 "total_questions_answered": 0,
+                "total_correct_answers": 0,
                 "overall_score": 0,
                 "recent_attempts": [],
                 "strengths": [],
                 "weaknesses": []
             }
         
-        total_questions = sum(a["total_questions"] for a in attempts)
-        total_score = sum(a["score_percentage"] for a in attempts)
-        avg_score = total_score / len(attempts) if attempts else 0
-        
-        # Get recent attempts
-        recent = attempts[:10]
-        recent_attempts = [
-            {
-                "date": a["submitted_at"].isoformat(),
-                "score": a["score_percentage"],
-                "questions": a["total_questions"]
-            }
-            for a in recent
-        ]
+        totals = totals[0]
+        avg_score = totals["avg_score"] or 0
         
         # Analyze strengths and weaknesses (simplified)
-        high_scores = [a for a in attempts if a["score_percentage"] >= 80]
-        low_scores = [a for a in attempts if a["score_percentage"] < 60]
-        
         strengths = []
         weaknesses = []
         
-        if high_scores:
-            strengths.append(f"Consistently scoring well ({len(high_scores)} quizzes above 80%)")
+        if totals["high"]:
+            strengths.append(f"Consistently scoring well ({totals['high']} quizzes above 80%)")
         
-        if low_scores:
-            weaknesses.append(f"Some challenging areas ({len(low_scores)} quizzes below 60%)")
+        if totals["low"]:
+            weaknesses.append(f"Some challenging areas ({totals['low']} quizzes below 60%)")
         
         if avg_score >= 70:
             strengths.append("Strong overall performance")
         
         return {
-            "total_quizzes": len(attempts),
-            "total_questions_answered": total_questions,
+            "total_quizzes": totals["count"],
+            "total_questions_answered": totals["total_questions"],
+            "total_correct_answers": totals["total_correct"],
             "overall_score": round(avg_score, 1),
             "recent_attempts": recent_attempts,
             "strengths": strengths,
@@ -985,24 +2219,34 @@ async def get_progress():
         }
         
     except Exception as e:
-        print(f"❌ Progress error: {str(e)}")
+        logger.error(f"❌ Progress error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ============================================================================
 # YOUTUBE RECOMMENDATION ROUTES
 # ============================================================================
-@app.post("/api/recommend/youtube")
-async def recommend_youtube(request: YouTubeRequest):
-    """Get YouTube video recommendations"""
-    try:
-        context = ""
-        if request.pdf_id:
-            pdf = await get_database()["pdfs"].find_one({"_id": ObjectId(request.pdf_id)})
-            if pdf:
-                all_text = " ".join(pdf["pages_text"].values())
-                context = all_text[:2000]
-        
-        prompt = f"""Recommend 3 educational YouTube videos for the topic: "{request.topic}"
+YOUTUBE_SYSTEM_PROMPT = "You are an educational content curator. Respond with ONLY valid JSON array, no markdown, no explanations."
+YOUTUBE_BATCH_MAX = 6
+YOUTUBE_BATCH_WINDOW_SECONDS = 0.05
+YOUTUBE_MAX_TOKENS = 300  # Per topic: three short title/channel/reason entries
+
+def parse_recommendations(response: str) -> List[Dict]:
+    """Parse one topic's recommendation list, raising ValueError if it's unusable"""
+    recommendations = parse_llm_json_list(response, "recommendations")
+    
+    # Validate
+    if not isinstance(recommendations, list):
+        raise ValueError("Response is not a list")
+    
+    # Ensure we have at least some recommendations
+    if len(recommendations) == 0:
+        raise ValueError("No recommendations in response")
+    
+    return recommendations
+
+async def fetch_recommendations(topic: str, context: str) -> List[Dict]:
+    """Ask the LLM for one topic's recommendations"""
+    prompt = f"""Recommend 3 educational YouTube videos for the topic: "{topic}"
 
 {f"Context from coursebook: {context}" if context else ""}
 
@@ -1022,37 +2266,148 @@ Focus on:
 
 RESPOND WITH ONLY THE JSON ARRAY, NO OTHER TEXT."""
 
-        system_prompt = "You are an educational content curator. Respond with ONLY valid JSON array, no markdown, no explanations."
-        
-        response = await call_llm(prompt, system_prompt, use_fallback=True)
+    response = await call_llm(
+        prompt, YOUTUBE_SYSTEM_PROMPT, use_fallback=True, response_format=YOUTUBE_RESPONSE_FORMAT,
+        max_tokens=YOUTUBE_MAX_TOKENS, validate=parse_recommendations
+    )
+    
+    try:
+        return parse_recommendations(response)
+    except Exception as e:
+        logger.debug(f"Response was: {response[:500]}")
+        raise ValueError(f"Failed to parse recommendations: {e}")
+
+async def fetch_recommendations_batch(items: List[Tuple[str, str]]) -> List[List[Dict]]:
+    """Ask for several topics' recommendations in one completion, indexed by position"""
+    topics = "\n\n".join(
+        f"[{i}] Topic: \"{topic}\"" + (f"\nContext from coursebook: {context}" if context else "")
+        for i, (topic, context) in enumerate(items, start=1)
+    )
+    prompt = f"""Recommend 3 educational YouTube videos for EACH of the numbered topics below.
+
+{topics}
+
+Provide recommendations as ONE JSON array with exactly {len(items)} entries, in the same order as the topics.
+Each entry is the array of recommendations for that topic, in this EXACT format:
+[
+  [
+    {{
+      "title": "Video title",
+      "channel": "Channel name",
+      "reason": "Why this video is recommended"
+    }}
+  ]
+]
+
+Focus on:
+- Educational channels (Khan Academy, Crash Course, etc.)
+- Clear explanations
+- Relevance to each topic
+
+RESPOND WITH ONLY THE JSON ARRAY, NO OTHER TEXT."""
+
+    response = await call_llm(
+        prompt, YOUTUBE_SYSTEM_PROMPT, use_fallback=True, response_format=YOUTUBE_BATCH_RESPONSE_FORMAT,
+        max_tokens=YOUTUBE_MAX_TOKENS * len(items),
+        validate=functools.partial(parse_recommendations_batch, count=len(items))
+    )
+    return parse_recommendations_batch(response, len(items))
+
+def parse_recommendations_batch(response: str, count: int) -> List[List[Dict]]:
+    """Parse a batched reply into one recommendation list per topic, raising ValueError if it's unusable"""
+    batch = parse_llm_json_list(response, "results")
+    if not isinstance(batch, list) or len(batch) != count:
+        raise ValueError(f"Expected {count} entries in batched response")
+    if not all(isinstance(entry, list) and entry for entry in batch):
+        raise ValueError("Batched response has an empty or malformed entry")
+    return batch
+
+class YouTubeBatcher:
+    """Coalesces concurrent recommendation requests into one batch-prompted LLM call"""
+    
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self.inflight = set()
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+    
+    async def submit(self, topic: str, context: str) -> List[Dict]:
+        if self.task is None:
+            return await fetch_recommendations(topic, context)
         
-        try:
-            # Clean response
-            response = response.strip()
-            if response.startswith('```'):
-                lines = response.split('\n')
-                response = '\n'.join(line for line in lines if not line.startswith('```'))
-                response = response.strip()
-            
-            if not response.startswith('['):
-                start = response.find('[')
-                end = response.rfind(']') + 1
-                if start != -1 and end > start:
-                    response = response[start:end]
-            
-            recommendations = json.loads(response)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((topic, context, future))
+        return await future
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
             
-            # Validate
-            if not isinstance(recommendations, list):
-                raise ValueError("Response is not a list")
+            # Wait briefly for other requests to share the completion
+            deadline = loop.time() + YOUTUBE_BATCH_WINDOW_SECONDS
+            while len(batch) < YOUTUBE_BATCH_MAX:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
             
-            # Ensure we have at least some recommendations
-            if len(recommendations) == 0:
-                raise ValueError("No recommendations in response")
+            task = asyncio.create_task(self.dispatch(batch))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+    
+    async def dispatch(self, batch: List[Tuple[str, str, asyncio.Future]]):
+        items = [(topic, context) for topic, context, _ in batch]
+        futures = [future for _, _, future in batch]
+        
+        if len(batch) > 1:
+            try:
+                results = await fetch_recommendations_batch(items)
+                logger.info(f"📦 Answered {len(batch)} recommendation requests in one LLM call")
+                for future, result in zip(futures, results):
+                    if not future.done():
+                        future.set_result(result)
+                return
+            except Exception as e:
+                logger.warning(f"⚠️  Batched recommendations failed, answering individually: {e}")
+        
+        results = await asyncio.gather(
+            *(fetch_recommendations(topic, context) for topic, context in items),
+            return_exceptions=True
+        )
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+youtube_batcher = YouTubeBatcher()
+
+@app.post("/api/recommend/youtube")
+async def recommend_youtube(request: YouTubeRequest):
+    """Get YouTube video recommendations"""
+    try:
+        context = ""
+        if request.pdf_id:
+            context = await get_context_text(parse_oid(request.pdf_id), 2000)
+        
+        try:
+            recommendations = await youtube_batcher.submit(request.topic, context)
             
         except Exception as e:
-            print(f"⚠️  Failed to parse recommendations: {e}")
-            print(f"Response was: {response[:500]}")
+            logger.warning(f"⚠️  Failed to parse recommendations: {e}")
             
             # Fallback recommendations
             recommendations = [
@@ -1078,10 +2433,10 @@ RESPOND WITH ONLY THE JSON ARRAY, NO OTHER TEXT."""
             "recommendations": recommendations
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ YouTube recommendation error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ YouTube recommendation error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ============================================================================
@@ -1089,12 +2444,28 @@ RESPOND WITH ONLY THE JSON ARRAY, NO OTHER TEXT."""
 # ============================================================================
 if __name__ == "__main__":
     import uvicorn
-    print("\n" + "="*60)
-    print("🚀 Starting BeyondChats Server...")
-    print("="*60)
-    print(f"📡 API: http://localhost:8000")
-    print(f"📚 Docs: http://localhost:8000/docs")
-    print(f"🔧 Health: http://localhost:8000/health")
-    print("="*60 + "\n")
-    
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    logger.info("="*60)
+    logger.info("🚀 Starting BeyondChats Server...")
+    logger.info("="*60)
+    logger.info(f"📡 API: http://localhost:8000")
+    logger.info(f"📚 Docs: http://localhost:8000/docs")
+    logger.info(f"🔧 Health: http://localhost:8000/health")
+    logger.info(f"👷 Workers: {WEB_CONCURRENCY}")
+    logger.info("="*60)
+    
+    # Workers re-import this module, so tell them how many siblings share the cores
+    os.environ["WEB_CONCURRENCY"] = str(WEB_CONCURRENCY)
+    
+    # Multiple workers need an import string; "auto" picks uvloop/httptools when installed
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=8000,
+        workers=WEB_CONCURRENCY,
+        loop="auto",
+        http="auto",
+        log_level="info",
+        # Leave logging to the queue-backed root handler configured above
+        log_config=None
+    )
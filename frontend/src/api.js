@@ -67,6 +67,50 @@ export const sendChatMessage = async (message, chatId = null, pdfId = null) => {
   return response.data;
 };
 
+// Streams the reply as server-sent events: first { chat_id, citations },
+// then { delta } chunks, then { done }. Uses fetch since axios can't stream in the browser.
+export const streamChatMessage = async (message, chatId = null, pdfId = null, { onMeta, onDelta } = {}) => {
+  const response = await fetch(`${API_BASE_URL}/api/chat/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      message,
+      chat_id: chatId,
+      pdf_id: pdfId,
+    }),
+  });
+  if (!response.ok) {
+    throw new Error(`Request failed with status code ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result = { chat_id: chatId, citations: [] };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const event = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      if (!event.startsWith('data: ')) continue;
+
+      const payload = JSON.parse(event.slice(6));
+      if (payload.delta !== undefined) {
+        onDelta?.(payload.delta);
+      } else if (payload.citations !== undefined) {
+        result = { chat_id: payload.chat_id, citations: payload.citations };
+        onMeta?.(result);
+      }
+    }
+  }
+  return result;
+};
+
 export const getChatHistory = async () => {
   const response = await api.get('/api/chat/history');
   return response.data;
@@ -841,20 +841,29 @@ export function ChatPage() {
 
     setLoading(true);
     try {
-      const data = await api.sendChatMessage(
+      await api.streamChatMessage(
         userMessage,
         currentChat,
-        selectedPdf?.pdf_id
+        selectedPdf?.pdf_id,
+        {
+          // Citations arrive before the reply, so show them while it streams in
+          onMeta: (data) => {
+            setCurrentChat(data.chat_id);
+            setMessages(prev => [...prev, {
+              role: 'assistant',
+              content: '',
+              citations: data.citations,
+              timestamp: new Date().toISOString()
+            }]);
+          },
+          onDelta: (delta) => {
+            setMessages(prev => {
+              const last = prev[prev.length - 1];
+              return [...prev.slice(0, -1), { ...last, content: last.content + delta }];
+            });
+          }
+        }
       );
-      
-      setCurrentChat(data.chat_id);
-      
-      setMessages(prev => [...prev, {
-        role: 'assistant',
-        content: data.message,
-        citations: data.citations,
-        timestamp: new Date().toISOString()
-      }]);
 
       await loadChatHistory();
     } catch (error) {
@@ -1039,7 +1048,7 @@ export function ChatPage() {
               <MessageBubble key={idx} message={message} />
             ))
           )}
-          {loading && (
+          {loading && messages[messages.length - 1]?.role !== 'assistant' && (
             <div className="flex items-center gap-3 p-4 bg-white rounded-2xl shadow-md w-fit">
               <div className="spinner w-5 h-5 border-2" />
               <span className="text-gray-600 font-medium">AI is thinking...</span>